@@ -3,13 +3,1268 @@ import cv2
 import numpy as np
 from PIL import Image
 import os
+import sys
+import json
+import base64
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from itertools import count
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: межпроцессная блокировка снимков недоступна
+    fcntl = None
+
+# Версии галерей уникальны в пределах процесса, в том числе между перезагрузками
+_gallery_versions = count(1)
+
+
+def squared_distances(queries, matrix, matrix_norms=None):
+    """Матрица квадратов евклидовых расстояний (F, N) через ||a||^2 + ||b||^2 - 2ab"""
+    query_norms = np.einsum('ij,ij->i', queries, queries)
+    if matrix_norms is None:
+        matrix_norms = np.einsum('ij,ij->i', matrix, matrix)
+    squared = query_norms[:, None] + matrix_norms[None, :] - 2.0 * (queries @ matrix.T)
+    return np.maximum(squared, 0.0)
+
+
+def nearest_centroids(data, centroids, batch_size=8192):
+    """Номер ближайшего центроида для каждой строки data (батчами, чтобы не держать всю матрицу N x K)"""
+    labels = np.empty(len(data), dtype=np.int64)
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    for start in range(0, len(data), batch_size):
+        chunk = data[start:start + batch_size]
+        labels[start:start + batch_size] = np.argmin(squared_distances(chunk, centroids, centroid_norms), axis=1)
+    return labels
+
+
+class IVFIndex:
+    """
+    Приближённый поиск ближайших соседей для больших галерей (чистый NumPy).
+    Грубый квантователь k-means делит галерею на списки; запрос проверяет nprobe
+    ближайших списков, а кандидаты ранжируются по точному расстоянию.
+    Списки хранят номера строк матрицы галереи, сами векторы не копируются
+    """
+    
+    def __init__(self, matrix, student_ids, nprobe=8, iterations=10, seed=0,
+                 centroids=None, labels=None, trained_size=None):
+        """
+        centroids, labels, trained_size: сохранённое состояние индекса (IVFIndex.row_labels и
+            центроиды из снимка на диске) - центроиды не обучаются, списки собираются по номерам
+        """
+        count = len(matrix)
+        if centroids is None:
+            centroids = self._train(matrix, iterations, seed)
+            trained_size = count
+        self.nlist = len(centroids)
+        self.nprobe = min(nprobe, self.nlist)
+        self.trained_size = trained_size or count
+        self.centroids = np.array(centroids, dtype=np.float32)
+        self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        
+        # Списки: номера строк (буфер с запасом ёмкости) и student_id в том же порядке
+        if labels is None:
+            labels = nearest_centroids(matrix, self.centroids)
+        labels = np.asarray(labels, dtype=np.int64)
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(self.nlist + 1))
+        self.list_rows = []
+        self.list_ids = []
+        self.list_sizes = np.zeros(self.nlist, dtype=np.int64)
+        # student_id -> (номер списка, позиция в списке)
+        self.position = {}
+        for label in range(self.nlist):
+            rows = order[bounds[label]:bounds[label + 1]]
+            self.list_rows.append(np.array(rows, dtype=np.int64))
+            self.list_ids.append([student_ids[row] for row in rows])
+            self.list_sizes[label] = len(rows)
+            for position, row in enumerate(rows):
+                self.position[student_ids[row]] = (label, position)
+    
+    @staticmethod
+    def _train(matrix, iterations, seed):
+        """Центроиды k-means (sqrt(N) списков), обученные на выборке до 64 точек на список"""
+        rng = np.random.default_rng(seed)
+        count = len(matrix)
+        nlist = max(1, int(np.sqrt(count)))
+        sample_size = min(count, nlist * 64)
+        sample = matrix[rng.choice(count, sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = nearest_centroids(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            sizes = np.bincount(labels, minlength=nlist)
+            empty = sizes == 0
+            centroids[~empty] = sums[~empty] / sizes[~empty, None]
+            # Пустые списки заново засеваются случайными точками
+            if empty.any():
+                centroids[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+        return centroids
+    
+    def row_labels(self, count):
+        """Номер списка для каждой из count строк галереи (для сохранения индекса в снимок)"""
+        labels = np.empty(count, dtype=np.int32)
+        for label in range(self.nlist):
+            labels[self.list_rows[label][:self.list_sizes[label]]] = label
+        return labels
+    
+    def add(self, student_id, row, vector):
+        """Добавить (или перенести) ученика в список ближайшего центроида"""
+        self.remove(student_id)
+        label = int(np.argmin(squared_distances(vector[None, :], self.centroids, self.centroid_norms)[0]))
+        size = int(self.list_sizes[label])
+        rows = self.list_rows[label]
+        if size >= len(rows):
+            grown = np.empty(max(16, len(rows) * 2), dtype=np.int64)
+            grown[:size] = rows[:size]
+            self.list_rows[label] = rows = grown
+        rows[size] = row
+        self.list_ids[label].append(student_id)
+        self.list_sizes[label] = size + 1
+        self.position[student_id] = (label, size)
+    
+    def remove(self, student_id):
+        """Удалить ученика из индекса (последний элемент списка переносится на его место)"""
+        entry = self.position.pop(student_id, None)
+        if entry is None:
+            return
+        label, position = entry
+        last = int(self.list_sizes[label]) - 1
+        ids = self.list_ids[label]
+        if position != last:
+            moved_student_id = ids[last]
+            self.list_rows[label][position] = self.list_rows[label][last]
+            ids[position] = moved_student_id
+            self.position[moved_student_id] = (label, position)
+        ids.pop()
+        self.list_sizes[label] = last
+    
+    def move(self, student_id, row):
+        """Строка ученика в матрице галереи изменилась"""
+        label, position = self.position[student_id]
+        self.list_rows[label][position] = row
+    
+    def search(self, queries, k, matrix, norms, decode=None):
+        """
+        top-k ближайших для каждого запроса с точными расстояниями
+        decode: перевод строк матрицы галереи во float32 (для float16/int8 хранения)
+        Returns: список списков (student_id, distance), отсортированных по расстоянию
+        """
+        probe_count = self.nprobe
+        centroid_distances = squared_distances(queries, self.centroids, self.centroid_norms)
+        probes = np.argpartition(centroid_distances, probe_count - 1, axis=1)[:, :probe_count]
+        
+        results = []
+        for query, query_probes in zip(queries, probes):
+            probe_rows = [self.list_rows[label][:self.list_sizes[label]] for label in query_probes]
+            rows = np.concatenate(probe_rows)
+            if len(rows) == 0:
+                results.append([])
+                continue
+            candidates_matrix = decode(matrix[rows]) if decode is not None else matrix[rows]
+            distances = squared_distances(query[None, :], candidates_matrix, norms[rows])[0]
+            top = np.argsort(distances)[:k] if k > 1 else [int(np.argmin(distances))]
+            
+            # Позиция кандидата -> (список, позиция в списке) для получения student_id
+            offsets = np.cumsum([0] + [len(r) for r in probe_rows])
+            candidates = []
+            for index in top:
+                probe = int(np.searchsorted(offsets, index, side='right')) - 1
+                student_id = self.list_ids[query_probes[probe]][index - offsets[probe]]
+                candidates.append((student_id, float(np.sqrt(distances[index]))))
+            results.append(candidates)
+        return results
+
+
+class FaceGallery:
+    """Галерея encodings одной школы (партиция)"""
+    
+    # Размерность face encoding из dlib
+    ENCODING_DIM = 128
+    
+    # Форматы хранения матрицы галереи; расстояния всегда считаются во float32
+    STORAGE_DTYPES = {
+        'float32': np.float32,
+        'float16': np.float16,
+        'int8': np.int8,
+    }
+    
+    # Шаг квантования int8 по умолчанию (значения dlib encoding лежат примерно в [-0.5, 0.5])
+    DEFAULT_INT8_SCALE = 0.5 / 127
+    
+    # Сколько строк галереи переводить во float32 за раз при полном переборе
+    CHUNK_ROWS = 8192
+    
+    # Сколько ближайших по центроиду учеников уточнять по их отдельным снимкам
+    SAMPLE_CANDIDATES = 5
+    # Сколько последних изменений помнит журнал галереи (догонка копий в процессах-воркерах)
+    CHANGE_LOG_SIZE = 1000
+    
+    def __init__(self, index_threshold=None, index_nprobe=8, storage='float32', scale=None):
+        """
+        index_threshold: с какого размера галереи искать через IVFIndex вместо полного перебора
+            (None - всегда полный перебор)
+        index_nprobe: сколько списков индекса проверять на запрос
+        storage: формат хранения матрицы - float32, float16 или int8 (с масштабом по измерениям)
+        scale: масштаб int8 по измерениям (по умолчанию считается при load)
+        """
+        if storage not in self.STORAGE_DTYPES:
+            raise ValueError(f"Неизвестный формат хранения галереи: {storage}")
+        self.index_threshold = index_threshold
+        self.storage = storage
+        self.index_nprobe = index_nprobe
+        self._dtype = self.STORAGE_DTYPES[storage]
+        self._scale = scale
+        self._index = None
+        # Поколение снимка на диске, к которому подключена галерея (общие галереи воркеров)
+        self.snapshot_generation = None
+        # Меняется при каждом изменении галереи (для синхронизации копий в процессах-воркерах)
+        self.version = next(_gallery_versions)
+        # Журнал upsert/remove: (версия, student_id, encoding или None - удаление, снимки).
+        # Покрывает все изменения после версии _changes_start
+        self._changes = deque(maxlen=self.CHANGE_LOG_SIZE)
+        self._changes_start = self.version
+        # Галерея хранится одной непрерывной матрицей (N, 128).
+        # _matrix - буфер с запасом ёмкости, занято первых _count строк
+        self._matrix = np.empty((0, self.ENCODING_DIM), dtype=self._dtype)
+        self._norms = np.empty((0,), dtype=np.float32)
+        self._count = 0
+        self.known_student_ids = []
+        # student_id -> номер строки в матрице галереи
+        self._row_by_student_id = {}
+        # student_id -> матрица (k, 128) float32 снимков ученика, только если их больше одного.
+        # В основной матрице у таких учеников хранится центроид снимков
+        self._samples = {}
+        self._lock = threading.RLock()
+    
+    def __len__(self):
+        return self._count
+    
+    @property
+    def known_encodings(self):
+        """Матрица (N, 128) encodings галереи в формате хранения"""
+        return self._matrix[:self._count]
+    
+    @property
+    def known_norms(self):
+        """Квадраты норм encodings галереи"""
+        return self._norms[:self._count]
+    
+    @property
+    def scale(self):
+        """Масштаб квантования int8 по измерениям (None для float форматов)"""
+        return self._scale
+    
+    @property
+    def nbytes(self):
+        """Память, занятая encodings галереи (без запаса ёмкости)"""
+        return self.known_encodings.nbytes + self.known_norms.nbytes
+    
+    def _encode(self, vectors):
+        """float32 -> формат хранения"""
+        if self.storage == 'int8':
+            return np.clip(np.rint(vectors / self._scale), -127, 127).astype(np.int8)
+        return vectors.astype(self._dtype, copy=False)
+    
+    def decode(self, stored):
+        """Формат хранения -> float32"""
+        if self.storage == 'int8':
+            return stored.astype(np.float32) * self._scale
+        return stored.astype(np.float32, copy=False)
+    
+    def load(self, encodings, student_ids, samples=None):
+        """
+        Пересобрать матрицу галереи из списка encodings
+        samples: словарь student_id -> снимки (k, 128) учеников с несколькими снимками
+        """
+        if len(encodings) > 0:
+            # Всегда копия: галерея меняет строки на месте и не должна портить массив вызывающего
+            vectors = np.array(encodings, dtype=np.float32).reshape(-1, self.ENCODING_DIM)
+        else:
+            vectors = np.empty((0, self.ENCODING_DIM), dtype=np.float32)
+        
+        if self.storage == 'int8' and self._scale is None:
+            # Масштаб по измерениям с запасом на будущие upsert; пустая галерея - масштаб по умолчанию
+            if len(vectors) > 0:
+                self._scale = np.maximum(np.abs(vectors).max(axis=0) * 1.25 / 127, 1e-4).astype(np.float32)
+            else:
+                self._scale = np.full(self.ENCODING_DIM, self.DEFAULT_INT8_SCALE, dtype=np.float32)
+        
+        matrix = self._encode(vectors)
+        decoded = self.decode(matrix)
+        
+        with self._lock:
+            self._matrix = matrix
+            # Квадраты норм считаются один раз при загрузке, а не на каждый кадр
+            self._norms = np.einsum('ij,ij->i', decoded, decoded)
+            self._count = len(matrix)
+            self.known_student_ids = list(student_ids)
+            self._row_by_student_id = {student_id: row for row, student_id in enumerate(self.known_student_ids)}
+            self._samples = self._prepare_samples(samples)
+            self._index = None
+            self._update_index_mode()
+            self.version = next(_gallery_versions)
+            # Галерея собрана заново - прежние изменения к ней не применить
+            self._changes.clear()
+            self._changes_start = self.version
+    
+    def _prepare_samples(self, samples):
+        """Снимки учеников галереи как матрицы float32 (учеников с одним снимком не хранит)"""
+        prepared = {}
+        for student_id, student_samples in (samples or {}).items():
+            if student_id not in self._row_by_student_id:
+                continue
+            student_samples = np.asarray(student_samples, dtype=np.float32).reshape(-1, self.ENCODING_DIM)
+            if len(student_samples) > 1:
+                prepared[student_id] = student_samples
+        return prepared
+    
+    @property
+    def samples(self):
+        """student_id -> снимки (k, 128) учеников с несколькими снимками"""
+        with self._lock:
+            return dict(self._samples)
+    
+    def attach(self, matrix, norms, student_ids, samples=None, index=None):
+        """
+        Использовать готовые массивы галереи без копирования (например, np.load(mmap_mode='r')
+        снимка с диска). Массивы только для чтения копируются при первом изменении галереи
+        index: сохранённое состояние IVFIndex ({'centroids', 'labels', 'trained_size'},
+            как у index_state) - индекс восстанавливается без обучения
+        """
+        matrix = np.asarray(matrix).reshape(-1, self.ENCODING_DIM)
+        if matrix.dtype != self._dtype:
+            raise ValueError(f"Формат матрицы {matrix.dtype} не совпадает с форматом галереи {self.storage}")
+        if self.storage == 'int8' and self._scale is None:
+            raise ValueError("Для int8 галереи нужен масштаб квантования")
+        
+        with self._lock:
+            self._matrix = matrix
+            self._norms = np.asarray(norms, dtype=np.float32)
+            self._count = len(matrix)
+            self.known_student_ids = list(student_ids)
+            self._row_by_student_id = {student_id: row for row, student_id in enumerate(self.known_student_ids)}
+            self._samples = self._prepare_samples(samples)
+            self._index = None
+            if index is not None and self.index_threshold and len(index['labels']) == self._count:
+                self._index = IVFIndex(matrix, self.known_student_ids, self.index_nprobe,
+                                       centroids=index['centroids'], labels=index['labels'],
+                                       trained_size=index['trained_size'])
+            self._update_index_mode()
+            self.version = next(_gallery_versions)
+            # Галерея собрана заново - прежние изменения к ней не применить
+            self._changes.clear()
+            self._changes_start = self.version
+    
+    def index_state(self):
+        """Состояние IVFIndex для снимка на диске: {'centroids', 'labels', 'trained_size'} или None"""
+        with self._lock:
+            if self._index is None:
+                return None
+            return {
+                'centroids': self._index.centroids,
+                'labels': self._index.row_labels(self._count),
+                'trained_size': self._index.trained_size,
+            }
+    
+    def _ensure_writable(self):
+        """Скопировать в память массивы, подключённые только для чтения"""
+        if not self._matrix.flags.writeable or not self._norms.flags.writeable:
+            self._matrix = np.array(self._matrix[:self._count])
+            self._norms = np.array(self._norms[:self._count])
+    
+    def _ensure_capacity(self, size):
+        """Увеличить буфер галереи (удвоением), чтобы вместить size строк"""
+        capacity = len(self._matrix)
+        if size <= capacity:
+            return
+        new_capacity = max(size, capacity * 2, 16)
+        matrix = np.empty((new_capacity, self.ENCODING_DIM), dtype=self._dtype)
+        norms = np.empty((new_capacity,), dtype=np.float32)
+        matrix[:self._count] = self._matrix[:self._count]
+        norms[:self._count] = self._norms[:self._count]
+        self._matrix = matrix
+        self._norms = norms
+    
+    def upsert(self, student_id, encoding, samples=None):
+        """
+        Добавить или заменить encoding ученика
+        samples: все снимки ученика (k, 128), если их несколько; encoding - их центроид
+        """
+        vector = np.asarray(encoding, dtype=np.float32).reshape(self.ENCODING_DIM)
+        
+        with self._lock:
+            if self.storage == 'int8':
+                self._fit_scale(vector)
+            
+            self._ensure_writable()
+            row = self._row_by_student_id.get(student_id)
+            if row is None:
+                self._ensure_capacity(self._count + 1)
+                row = self._count
+                self._count += 1
+                self.known_student_ids.append(student_id)
+                self._row_by_student_id[student_id] = row
+            
+            self._matrix[row] = self._encode(vector[None, :])[0]
+            decoded = self.decode(self._matrix[row])
+            self._norms[row] = np.dot(decoded, decoded)
+            if self._index is not None:
+                self._index.add(student_id, row, decoded)
+            prepared = self._prepare_samples({student_id: samples} if samples is not None else None)
+            if prepared:
+                self._samples[student_id] = prepared[student_id]
+            else:
+                self._samples.pop(student_id, None)
+            self._update_index_mode()
+            self.version = next(_gallery_versions)
+            self._log_change(student_id, vector.copy(), prepared.get(student_id))
+    
+    def _fit_scale(self, vector):
+        """
+        Расширить масштаб int8 по измерениям, в которые не помещается vector (иначе np.clip
+        молча обрезал бы его значения). Матрица перекодируется в новом масштабе - O(N), но
+        только когда новый ученик выходит за диапазон, подобранный при загрузке
+        """
+        if self._scale is None:
+            self._scale = np.full(self.ENCODING_DIM, self.DEFAULT_INT8_SCALE, dtype=np.float32)
+        needed = np.abs(vector) / 127
+        if not (needed > self._scale).any():
+            return
+        decoded = self.decode(self.known_encodings)
+        # Тот же запас 25%, что и при загрузке
+        self._scale = np.maximum(self._scale, needed * 1.25).astype(np.float32)
+        matrix = np.empty(self._matrix.shape, dtype=np.int8)
+        matrix[:self._count] = self._encode(decoded)
+        decoded = self.decode(matrix[:self._count])
+        norms = np.empty(self._norms.shape, dtype=np.float32)
+        norms[:self._count] = np.einsum('ij,ij->i', decoded, decoded)
+        self._matrix = matrix
+        self._norms = norms
+    
+    def remove(self, student_id):
+        """
+        Удалить ученика (последняя строка переносится на место удалённой)
+        Returns: True если ученик был в галерее
+        """
+        with self._lock:
+            row = self._row_by_student_id.pop(student_id, None)
+            if row is None:
+                return False
+            self._samples.pop(student_id, None)
+            
+            if self._index is not None:
+                self._index.remove(student_id)
+            
+            self._ensure_writable()
+            last = self._count - 1
+            if row != last:
+                moved_student_id = self.known_student_ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._norms[row] = self._norms[last]
+                self.known_student_ids[row] = moved_student_id
+                self._row_by_student_id[moved_student_id] = row
+                if self._index is not None:
+                    self._index.move(moved_student_id, row)
+            
+            self.known_student_ids.pop()
+            self._count = last
+            self._update_index_mode()
+            self.version = next(_gallery_versions)
+            self._log_change(student_id, None, None)
+            return True
+    
+    def _log_change(self, student_id, encoding, samples):
+        """Записать изменение в журнал (самое старое вытесняется)"""
+        if len(self._changes) == self._changes.maxlen:
+            self._changes_start = self._changes[0][0]
+        self._changes.append((self.version, student_id, encoding, samples))
+    
+    def changes_since(self, version):
+        """
+        Изменения галереи после версии version - по ним копия галереи в другом процессе
+        догоняет эту без полной перезагрузки
+        Returns: (since, список (версия, student_id, encoding или None, снимки)) - все изменения
+            после версии since >= version; since > version, если журнал уже не помнит более ранние
+        """
+        with self._lock:
+            since = max(version, self._changes_start)
+            return since, [change for change in self._changes if change[0] > since]
+    
+    @property
+    def uses_index(self):
+        """Поиск идёт через IVFIndex, а не полным перебором"""
+        return self._index is not None
+    
+    def _update_index_mode(self):
+        """
+        Переключение между полным перебором и индексом по размеру галереи.
+        Индекс перестраивается, когда галерея выросла вдвое с момента обучения
+        """
+        if not self.index_threshold:
+            return
+        if self._index is None:
+            if self._count >= self.index_threshold:
+                self._index = IVFIndex(self.decode(self.known_encodings), self.known_student_ids, self.index_nprobe)
+        elif self._count < self.index_threshold // 2:
+            self._index = None
+        elif self._count > self._index.trained_size * 2:
+            self._index = IVFIndex(self.decode(self.known_encodings), self.known_student_ids, self.index_nprobe)
+    
+    def _squared_distances(self, queries):
+        """Квадраты расстояний (F, N) до всей галереи, матрица переводится во float32 по частям"""
+        squared = np.empty((len(queries), self._count), dtype=np.float32)
+        if self.storage == 'float32':
+            squared[:] = squared_distances(queries, self.known_encodings, self.known_norms)
+            return squared
+        for start in range(0, self._count, self.CHUNK_ROWS):
+            stop = min(start + self.CHUNK_ROWS, self._count)
+            chunk = self.decode(self._matrix[start:stop])
+            squared[:, start:stop] = squared_distances(queries, chunk, self._norms[start:stop])
+        return squared
+    
+    def search(self, queries, k=1):
+        """
+        top-k ближайших учеников для каждого запроса (F, 128) с точными расстояниями
+        Returns: список списков (student_id, distance), отсортированных по расстоянию
+        """
+        with self._lock:
+            if self._count == 0:
+                return [[] for _ in range(len(queries))]
+            
+            if self._index is not None:
+                return self._index.search(queries, k, self.known_encodings, self.known_norms, self.decode)
+            
+            squared = self._squared_distances(queries)
+            k = min(k, self._count)
+            if k == 1:
+                top = np.argmin(squared, axis=1)[:, None]
+            else:
+                top = np.argpartition(squared, k - 1, axis=1)[:, :k]
+                order = np.argsort(np.take_along_axis(squared, top, axis=1), axis=1)
+                top = np.take_along_axis(top, order, axis=1)
+            distances = np.sqrt(np.take_along_axis(squared, top, axis=1))
+            return [
+                [(self.known_student_ids[index], float(distance)) for index, distance in zip(row, row_distances)]
+                for row, row_distances in zip(top, distances)
+            ]
+    
+    def subset(self, student_ids):
+        """Новая галерея только из указанных учеников (строки копируются, без индекса)"""
+        gallery = FaceGallery(storage=self.storage, scale=self._scale)
+        with self._lock:
+            present_ids = [student_id for student_id in student_ids if student_id in self._row_by_student_id]
+            rows = [self._row_by_student_id[student_id] for student_id in present_ids]
+            samples = {student_id: self._samples[student_id] for student_id in present_ids if student_id in self._samples}
+            gallery.load(self.decode(self._matrix[rows]), present_ids, samples)
+        return gallery
+    
+    def match(self, queries, tolerance):
+        """
+        Сопоставить матрицу encodings (F, 128) с галереей одним батчем.
+        Если у учеников несколько снимков: сначала SAMPLE_CANDIDATES ближайших по центроиду,
+        затем для них точный минимум расстояния по отдельным снимкам
+        Returns: список (student_id или None, distance или None) для каждого лица
+        """
+        with self._lock:
+            samples = dict(self._samples)
+        k = self.SAMPLE_CANDIDATES if samples else 1
+        
+        results = []
+        for query, candidates in zip(queries, self.search(queries, k=k)):
+            if not candidates:
+                results.append((None, None))
+                continue
+            if samples:
+                candidates = [
+                    (student_id, float(np.sqrt(np.min(np.sum((samples[student_id] - query) ** 2, axis=1)))))
+                    if student_id in samples else (student_id, distance)
+                    for student_id, distance in candidates
+                ]
+            student_id, distance = min(candidates, key=lambda candidate: candidate[1])
+            if distance <= tolerance:
+                results.append((student_id, distance))
+            else:
+                results.append((None, distance))
+        return results
+
+
+class GallerySnapshotStore:
+    """
+    Снимки галерей школ на диске: матрица, квадраты норм и id учеников в .npy,
+    метаданные (версия, формат, масштаб int8) в .json.
+    Снимок подключается через np.load(mmap_mode='r'), страницы делятся между процессами ОС
+    """
+    
+    # Сколько секунд не удалять чужие поколения снимка
+    GENERATION_GRACE_SECONDS = 60
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # Уникальность имён поколений внутри процесса
+        self._generations = count(1)
+    
+    def _key(self, school_id):
+        return 'all' if school_id is None else f"school_{school_id}"
+    
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+    
+    def load(self, school_id):
+        """
+        Подключить снимок галереи школы
+        Returns: словарь {'version', 'storage', 'scale', 'matrix', 'norms', 'student_ids', 'samples',
+            'index'} или None
+        """
+        key = self._key(school_id)
+        try:
+            with open(self._path(f"{key}.json"), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            generation = meta['generation']
+            matrix = np.load(self._path(f"{key}.{generation}.matrix.npy"), mmap_mode='r')
+            norms = np.load(self._path(f"{key}.{generation}.norms.npy"), mmap_mode='r')
+            student_ids = np.load(self._path(f"{key}.{generation}.ids.npy"))
+            samples = {}
+            if meta.get('samples'):
+                sample_matrix = np.load(self._path(f"{key}.{generation}.samples.npy"), mmap_mode='r')
+                sample_owners = np.load(self._path(f"{key}.{generation}.sample_ids.npy"))
+                # Снимки одного ученика записаны подряд
+                bounds = np.flatnonzero(np.diff(sample_owners)) + 1
+                for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(sample_owners)]):
+                    samples[int(sample_owners[start])] = sample_matrix[start:stop]
+            index = None
+            if meta.get('index_trained_size'):
+                index = {
+                    'centroids': np.load(self._path(f"{key}.{generation}.centroids.npy")),
+                    'labels': np.load(self._path(f"{key}.{generation}.labels.npy"), mmap_mode='r'),
+                    'trained_size': meta['index_trained_size'],
+                }
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Снимок галереи {key} повреждён: {e}")
+            return None
+        
+        if not len(matrix) == len(norms) == len(student_ids):
+            print(f"Снимок галереи {key} повреждён: размеры массивов не совпадают")
+            return None
+        
+        scale = meta.get('scale')
+        return {
+            'version': meta['version'],
+            'generation': generation,
+            'storage': meta['storage'],
+            'scale': np.asarray(scale, dtype=np.float32) if scale is not None else None,
+            'matrix': matrix,
+            'norms': norms,
+            'student_ids': student_ids.tolist(),
+            'samples': samples,
+            'index': index,
+        }
+    
+    def generation(self, school_id):
+        """Текущее поколение снимка школы (None - снимка нет)"""
+        try:
+            with open(self._path(f"{self._key(school_id)}.json"), 'r', encoding='utf-8') as f:
+                return json.load(f).get('generation')
+        except (OSError, ValueError):
+            return None
+    
+    @contextmanager
+    def lock(self, school_id):
+        """Межпроцессная блокировка снимка школы на время чтения-изменения-записи"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(f"{self._key(school_id)}.lock"), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def save(self, school_id, gallery, version):
+        """
+        Записать снимок галереи. version - момент (time.time()), на который снимок актуален.
+        Файлы нового поколения пишутся рядом, затем атомарно подменяется .json
+        """
+        key = self._key(school_id)
+        generation = f"{int(time.time() * 1000)}-{os.getpid()}-{next(self._generations)}"
+        with gallery._lock:
+            matrix = np.array(gallery.known_encodings)
+            norms = np.array(gallery.known_norms)
+            student_ids = np.asarray(gallery.known_student_ids, dtype=np.int64)
+            scale = gallery.scale
+            samples = gallery.samples
+            index = gallery.index_state()
+        
+        meta = {
+            'version': version,
+            'generation': generation,
+            'storage': gallery.storage,
+            'count': len(student_ids),
+            'scale': scale.tolist() if scale is not None else None,
+            'samples': sum(len(student_samples) for student_samples in samples.values()),
+            'index_trained_size': index['trained_size'] if index is not None else None,
+        }
+        
+        with self._lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                np.save(self._path(f"{key}.{generation}.matrix.npy"), matrix)
+                np.save(self._path(f"{key}.{generation}.norms.npy"), norms)
+                np.save(self._path(f"{key}.{generation}.ids.npy"), student_ids)
+                if samples:
+                    np.save(self._path(f"{key}.{generation}.samples.npy"), np.vstack(list(samples.values())))
+                    np.save(self._path(f"{key}.{generation}.sample_ids.npy"), np.concatenate([
+                        np.full(len(student_samples), student_id, dtype=np.int64)
+                        for student_id, student_samples in samples.items()
+                    ]))
+                if index is not None:
+                    # Индекс сохраняется вместе со снимком, чтобы процессы не обучали его заново
+                    np.save(self._path(f"{key}.{generation}.centroids.npy"), index['centroids'])
+                    np.save(self._path(f"{key}.{generation}.labels.npy"), index['labels'])
+                meta_tmp = self._path(f"{key}.{generation}.json.tmp")
+                with open(meta_tmp, 'w', encoding='utf-8') as f:
+                    json.dump(meta, f)
+                os.replace(meta_tmp, self._path(f"{key}.json"))
+            except OSError as e:
+                print(f"Не удалось сохранить снимок галереи {key}: {e}")
+                return False
+            self._remove_old_generations(key, generation)
+        return True
+    
+    def _remove_old_generations(self, key, generation):
+        """
+        Удалить файлы прошлых поколений (подключённые процессами mmap остаются валидными).
+        Свежие поколения не трогаются: их может прямо сейчас записывать другой процесс
+        """
+        prefix = f"{key}."
+        oldest_kept = int(time.time() * 1000) - self.GENERATION_GRACE_SECONDS * 1000
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix) or name in (f"{key}.json", f"{key}.lock"):
+                continue
+            other_generation = name[len(prefix):].split('.', 1)[0]
+            if other_generation == generation:
+                continue
+            try:
+                created_ms = int(other_generation.split('-', 1)[0])
+            except ValueError:
+                continue
+            if created_ms > oldest_kept:
+                continue
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+
+def normalize_roi(value):
+    """
+    Области интереса камеры: прямоугольник [x1, y1, x2, y2] или список прямоугольников
+    в долях кадра (0..1)
+    Returns: список кортежей (x1, y1, x2, y2)
+    Raises: ValueError при некорректных значениях
+    """
+    if not value:
+        return []
+    rectangles = [value] if not isinstance(value[0], (list, tuple)) else value
+    normalized = []
+    for rectangle in rectangles:
+        if len(rectangle) != 4:
+            raise ValueError("Область интереса задаётся как [x1, y1, x2, y2]")
+        x1, y1, x2, y2 = (float(coordinate) for coordinate in rectangle)
+        if not (0 <= x1 < x2 <= 1 and 0 <= y1 < y2 <= 1):
+            raise ValueError("Координаты области интереса - доли кадра от 0 до 1, x1 < x2, y1 < y2")
+        normalized.append((x1, y1, x2, y2))
+    return normalized
+
+
+def estimate_yaw(landmarks):
+    """
+    Грубая оценка поворота головы влево-вправо (градусы, по модулю) по 5 точкам face_landmarks
+    (model='small'): смещение кончика носа от середины глаз вдоль линии глаз
+    """
+    left_eye = np.mean(landmarks['left_eye'], axis=0)
+    right_eye = np.mean(landmarks['right_eye'], axis=0)
+    nose = np.mean(landmarks['nose_tip'], axis=0)
+    eye_distance = np.linalg.norm(right_eye - left_eye)
+    if eye_distance == 0:
+        return 90.0
+    axis = (right_eye - left_eye) / eye_distance
+    # 0 - нос посередине между глазами, 0.5 - нос на уровне одного из глаз (профиль)
+    offset = np.dot(nose - (left_eye + right_eye) / 2, axis) / eye_distance
+    return float(np.degrees(np.arcsin(np.clip(abs(offset) * 2, 0, 1))))
+
+
+def frame_hash(gray):
+    """
+    Перцептивный хэш кадра (dHash, 64 бита): знаки разностей соседних пикселей
+    кадра, уменьшенного до 9x8. Почти одинаковые кадры дают хэши с малым расстоянием Хэмминга
+    gray: кадр в оттенках серого (любого размера)
+    """
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+
+def hamming_distance(hash_a, hash_b):
+    """Число различающихся бит двух хэшей"""
+    return bin(hash_a ^ hash_b).count('1')
+
+
+def box_iou(box_a, box_b):
+    """IoU двух рамок (top, right, bottom, left)"""
+    top = max(box_a[0], box_b[0])
+    right = min(box_a[1], box_b[1])
+    bottom = min(box_a[2], box_b[2])
+    left = max(box_a[3], box_b[3])
+    if right <= left or bottom <= top:
+        return 0.0
+    intersection = (right - left) * (bottom - top)
+    area_a = (box_a[1] - box_a[3]) * (box_a[2] - box_a[0])
+    area_b = (box_b[1] - box_b[3]) * (box_b[2] - box_b[0])
+    return intersection / float(area_a + area_b - intersection)
+
+
+class FaceTracker:
+    """
+    Трекинг лиц между кадрами одной камеры.
+    Рамка, сильно перекрывающаяся (IoU) с уже опознанным треком, получает его student_id
+    без повторного encoding, но не дольше max_reuse_frames кадров подряд
+    """
+    
+    def __init__(self, iou_threshold=0.5, max_reuse_frames=5):
+        self.iou_threshold = iou_threshold
+        self.max_reuse_frames = max_reuse_frames
+        # Треки предыдущего кадра: location, student_id, distance, reused
+        self.tracks = []
+        self.last_seen = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def assign(self, locations):
+        """
+        Сопоставить рамки нового кадра с опознанными треками
+        Returns: список трек/None для каждой рамки
+        """
+        self.last_seen = time.monotonic()
+        assigned = []
+        used = set()
+        for location in locations:
+            best_track = None
+            best_iou = self.iou_threshold
+            for index, track in enumerate(self.tracks):
+                if index in used or track['student_id'] is None:
+                    continue
+                if track['reused'] >= self.max_reuse_frames:
+                    continue
+                iou = box_iou(location, track['location'])
+                if iou >= best_iou:
+                    best_iou = iou
+                    best_track = index
+            if best_track is not None:
+                used.add(best_track)
+                assigned.append(self.tracks[best_track])
+            else:
+                assigned.append(None)
+        return assigned
+    
+    def update(self, locations, results, assigned):
+        """Заменить треки результатами текущего кадра"""
+        tracks = []
+        for location, (student_id, distance), track in zip(locations, results, assigned):
+            tracks.append({
+                'location': location,
+                'student_id': student_id,
+                'distance': distance,
+                'reused': track['reused'] + 1 if track is not None else 0
+            })
+        self.tracks = tracks
+
+
+class StageTimer:
+    """
+    Длительности этапов обработки одного кадра (мс) и счётчики:
+    faces_detected, faces_encoded, gallery_size, best_distance и т.п.
+    """
+    
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+    
+    @contextmanager
+    def stage(self, name):
+        """Замерить этап (повторные замеры одного этапа суммируются)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - started) * 1000)
+    
+    def record(self, name, milliseconds):
+        """Добавить уже измеренную длительность этапа"""
+        self.stages[name] = self.stages.get(name, 0.0) + milliseconds
+    
+    def add(self, name, value=1):
+        """Увеличить счётчик"""
+        self.counts[name] = self.counts.get(name, 0) + value
+    
+    def set(self, name, value):
+        """Задать значение (например, размер галереи)"""
+        self.counts[name] = value
+    
+    def set_min(self, name, value):
+        """Запомнить наименьшее значение (например, лучшее расстояние кадра)"""
+        if value is not None and (self.counts.get(name) is None or value < self.counts[name]):
+            self.counts[name] = value
+    
+    def merge(self, timings):
+        """Добавить замеры из другого процесса (результат as_dict)"""
+        if not timings:
+            return
+        for name, milliseconds in timings.get('stages', {}).items():
+            self.record(name, milliseconds)
+        for name, value in timings.get('counts', {}).items():
+            if name == 'best_distance':
+                self.set_min(name, value)
+            elif name == 'gallery_size':
+                self.set(name, value)
+            else:
+                self.add(name, value)
+    
+    def as_dict(self):
+        """Замеры как словарь (передаётся между процессами, отдаётся в API)"""
+        return {'stages': dict(self.stages), 'counts': dict(self.counts)}
+    
+    def server_timing(self):
+        """Значение HTTP-заголовка Server-Timing: decode;dur=3.1, detect;dur=84.0, ..."""
+        return ', '.join(f"{name};dur={milliseconds:.1f}" for name, milliseconds in self.stages.items())
+
+
+class TimingStats:
+    """
+    Скользящая статистика замеров кадров: последние window кадров каждой школы
+    и каждой камеры, перцентили p50/p95/p99 по этапам
+    """
+    
+    PERCENTILES = (50, 95, 99)
+    
+    def __init__(self, window=500):
+        self.window = window
+        # school_id -> deque замеров; (school_id, camera_id) -> deque замеров
+        self._schools = {}
+        self._cameras = {}
+        self._lock = threading.Lock()
+    
+    def add(self, school_id, camera_id, timings):
+        """Учесть замеры кадра (StageTimer.as_dict)"""
+        with self._lock:
+            self._schools.setdefault(school_id, deque(maxlen=self.window)).append(timings)
+            if camera_id is not None:
+                self._cameras.setdefault((school_id, camera_id), deque(maxlen=self.window)).append(timings)
+    
+    @classmethod
+    def summarize(cls, samples):
+        """Перцентили этапов и средние счётчики по списку замеров"""
+        stages = {}
+        counts = {}
+        for timings in samples:
+            for name, milliseconds in timings['stages'].items():
+                stages.setdefault(name, []).append(milliseconds)
+            for name, value in timings['counts'].items():
+                if value is not None:
+                    counts.setdefault(name, []).append(value)
+        
+        summary = {'frames': len(samples), 'stages': {}, 'counts': {}}
+        for name, values in stages.items():
+            percentiles = np.percentile(values, cls.PERCENTILES)
+            summary['stages'][name] = dict(
+                {f'p{p}': round(float(value), 2) for p, value in zip(cls.PERCENTILES, percentiles)},
+                count=len(values)
+            )
+        for name, values in counts.items():
+            summary['counts'][name] = {
+                'mean': round(float(np.mean(values)), 4),
+                'p50': round(float(np.percentile(values, 50)), 4),
+                'max': round(float(np.max(values)), 4),
+                'count': len(values),
+            }
+        return summary
+    
+    def get_stats(self, school_id=None, all_schools=False):
+        """
+        Сводка по школе и её камерам (all_schools - по всем школам процесса)
+        Returns: {'schools': {school_id: сводка}, 'cameras': {'school_id/camera_id': сводка}}
+        """
+        with self._lock:
+            schools = {key: list(samples) for key, samples in self._schools.items()
+                       if all_schools or key == school_id}
+            cameras = {key: list(samples) for key, samples in self._cameras.items()
+                       if all_schools or key[0] == school_id}
+        return {
+            'schools': {str(key): self.summarize(samples) for key, samples in schools.items()},
+            'cameras': {f"{key[0]}/{key[1]}": self.summarize(samples) for key, samples in cameras.items()},
+        }
+
+
+# ===== ДЕТЕКТОРЫ ЛИЦ =====
+# Все детекторы принимают RGB кадр и возвращают рамки (top, right, bottom, left):
+# hog - HOG dlib (по умолчанию), cnn - CNN (mmod) dlib, точнее на мелких и повёрнутых лицах,
+# но медленный на CPU, dnn - OpenCV DNN ResNet-SSD (модель скачивается отдельно),
+# haar - каскад Хаара OpenCV, самый быстрый, но только фронтальные лица
+
+class FaceDetector:
+    """Базовый детектор лиц"""
+    
+    name = None
+    
+    def detect(self, rgb_frame):
+        """
+        Найти лица на кадре
+        Returns: список (top, right, bottom, left)
+        """
+        raise NotImplementedError
+
+
+class HogFaceDetector(FaceDetector):
+    """HOG детектор dlib"""
+    
+    name = 'hog'
+    model = 'hog'
+    
+    def __init__(self, upsample=1):
+        self.upsample = upsample
+    
+    def detect(self, rgb_frame):
+        return face_recognition.face_locations(rgb_frame, number_of_times_to_upsample=self.upsample, model=self.model)
+
+
+class CnnFaceDetector(HogFaceDetector):
+    """CNN (mmod) детектор dlib"""
+    
+    name = 'cnn'
+    model = 'cnn'
+
+
+class OpenCvDnnFaceDetector(FaceDetector):
+    """OpenCV DNN ResNet-SSD (Caffe модель res10_300x300_ssd_iter_140000)"""
+    
+    name = 'dnn'
+    
+    # Каталог модели по умолчанию; файлы не входят в репозиторий
+    MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'face_detector_models')
+    
+    def __init__(self, prototxt=None, model=None, confidence=0.5, input_size=300):
+        prototxt = prototxt or os.environ.get('FACE_DNN_PROTOTXT') or os.path.join(self.MODEL_DIR, 'deploy.prototxt')
+        model = model or os.environ.get('FACE_DNN_MODEL') or os.path.join(self.MODEL_DIR, 'res10_300x300_ssd_iter_140000.caffemodel')
+        for path in (prototxt, model):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Файл модели детектора dnn не найден: {path}")
+        self.net = cv2.dnn.readNetFromCaffe(prototxt, model)
+        self.confidence = confidence
+        self.input_size = input_size
+        # cv2.dnn.Net не потокобезопасен
+        self._lock = threading.Lock()
+    
+    def detect(self, rgb_frame):
+        height, width = rgb_frame.shape[:2]
+        # Модель обучена на BGR со средним (104, 177, 123); swapRB переводит RGB кадр в BGR
+        blob = cv2.dnn.blobFromImage(
+            rgb_frame, 1.0, (self.input_size, self.input_size), (104.0, 177.0, 123.0), swapRB=True
+        )
+        with self._lock:
+            self.net.setInput(blob)
+            detections = self.net.forward()
+        
+        locations = []
+        for detection in detections[0, 0]:
+            if float(detection[2]) < self.confidence:
+                continue
+            left = max(0, int(detection[3] * width))
+            top = max(0, int(detection[4] * height))
+            right = min(width, int(detection[5] * width))
+            bottom = min(height, int(detection[6] * height))
+            if right > left and bottom > top:
+                locations.append((top, right, bottom, left))
+        return locations
+
+
+class HaarFaceDetector(FaceDetector):
+    """Каскад Хаара OpenCV (фронтальные лица)"""
+    
+    name = 'haar'
+    
+    def __init__(self, scale_factor=1.1, min_neighbors=5, min_size=40, cascade=None):
+        cascade = cascade or os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+        self.classifier = cv2.CascadeClassifier(cascade)
+        if self.classifier.empty():
+            raise FileNotFoundError(f"Каскад Хаара не загружен: {cascade}")
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+    
+    def detect(self, rgb_frame):
+        gray = cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2GRAY)
+        boxes = self.classifier.detectMultiScale(
+            gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+            minSize=(self.min_size, self.min_size)
+        )
+        return [(int(y), int(x + w), int(y + h), int(x)) for x, y, w, h in boxes]
+
+
+DETECTORS = {
+    detector.name: detector
+    for detector in (HogFaceDetector, CnnFaceDetector, OpenCvDnnFaceDetector, HaarFaceDetector)
+}
+
+
+def create_detector(name, upsample=1):
+    """
+    Создать детектор по имени (hog, cnn, dnn, haar)
+    upsample: number_of_times_to_upsample для детекторов dlib
+    """
+    if name not in DETECTORS:
+        raise ValueError(f"Неизвестный детектор лиц: {name}")
+    detector_class = DETECTORS[name]
+    if issubclass(detector_class, HogFaceDetector):
+        return detector_class(upsample)
+    return detector_class()
+
 
 class FaceRecognitionService:
     """Сервис для распознавания лиц"""
     
-    def __init__(self):
-        self.known_encodings = []
-        self.known_student_ids = []
+    ENCODING_DIM = FaceGallery.ENCODING_DIM
+    
+    # Через сколько секунд без кадров трекер камеры удаляется
+    TRACKER_TTL_SECONDS = 60
+    
+    # Минимальная сторона вырезки лица для recognize_chips (меньше - encoding ненадёжен)
+    MIN_CHIP_SIZE = 64
+    
+    # Во сколько раз сторона вырезки больше рамки лица (запас по краям, camera.js режет так же)
+    CHIP_MARGIN = 1.3
+    
+    # До какого размера приводится лицо перед оценкой резкости (порог не зависит от расстояния)
+    SHARPNESS_FACE_SIZE = 100
+    
+    # Причины отказа от encoding лица
+    REJECT_SMALL = 'small'
+    REJECT_BLURRY = 'blurry'
+    REJECT_TURNED = 'turned'
+    
+    # На сколько секунд раньше прошлой сверки состояния запрашиваются изменения учеников из БД
+    STATE_SYNC_GRACE_SECONDS = 60
+    
+    def __init__(self, tolerance=0.6, max_galleries=32, gallery_loader=None,
+                 detection_scale=1.0, upsample=1, tracking_frames=0, tracking_iou=0.5,
+                 priority_loader=None, priority_refresh_seconds=60, index_threshold=20000,
+                 storage='float32', snapshot_store=None, changes_loader=None,
+                 shared_galleries=False, shared_check_seconds=1.0, state_loader=None,
+                 state_check_seconds=10.0, detector='hog',
+                 camera_settings_loader=None, camera_settings_refresh_seconds=60,
+                 min_face_size=0, min_sharpness=0, max_yaw=0,
+                 frame_cache_seconds=0, frame_cache_distance=4, timing_window=500):
+        """
+        tolerance: порог расстояния для совпадения
+        max_galleries: сколько галерей школ держать в памяти (LRU)
+        gallery_loader: функция school_id -> список Student для ленивой загрузки галереи
+        detection_scale: масштаб кадра для поиска лиц (0.5, 0.25...); encoding всегда по полному кадру
+        upsample: сколько раз увеличивать кадр при поиске лиц (number_of_times_to_upsample)
+        tracking_frames: сколько кадров подряд переиспользовать опознание трека (0 - трекинг выключен)
+        tracking_iou: минимальный IoU рамки с треком для переиспользования
+        priority_loader: функция school_id -> id учеников, которых вероятнее всего ждём сейчас
+            (например, группы, у которых скоро занятие); они сравниваются первыми
+        priority_refresh_seconds: как часто пересчитывать список priority_loader
+        index_threshold: с какого размера галереи использовать приближённый индекс (None - никогда)
+        storage: формат хранения галерей - float32, float16 или int8
+        snapshot_store: GallerySnapshotStore для быстрой загрузки галерей с диска
+        changes_loader: функция (school_id, since, known_ids) -> (id активных учеников с encoding,
+            список Student, изменённых после since или отсутствующих в known_ids);
+            без неё снимки не используются
+        shared_galleries: галереи всех процессов подключены к одному снимку на диске; upsert/remove
+            публикуют новое поколение снимка, остальные процессы переключаются на него
+        shared_check_seconds: как часто проверять, не появилось ли новое поколение снимка
+        state_loader: функция school_id -> состояние учеников школы в БД (например, число активных
+            с encoding и время последнего изменения encoding). Для галерей без общего снимка:
+            upsert/remove меняют только процесс, принявший запрос, а остальные процессы по смене
+            состояния догружают изменения из БД (через changes_loader или полной перезагрузкой)
+        state_check_seconds: как часто сверять состояние школы (state_loader)
+        detector: детектор лиц по умолчанию - hog, cnn, dnn или haar
+        camera_settings_loader: функция school_id -> {camera_id: настройки камеры}
+            (ключ 'default' - для всех камер школы), например
+            {'detector': 'haar', 'roi': [0.2, 0.1, 0.8, 0.9]} (область интереса в долях кадра)
+        camera_settings_refresh_seconds: как долго кэшировать настройки камер школы
+        min_face_size: лица с меньшей стороной рамки (px) не распознаются (0 - без проверки)
+        min_sharpness: минимальная дисперсия лапласиана лица (0 - без проверки размытия)
+        max_yaw: максимальный поворот головы в градусах по 5 точкам лица (0 - без проверки)
+        frame_cache_seconds: сколько секунд результат кадра камеры переиспользуется для почти
+            такого же кадра (0 - без кэша)
+        frame_cache_distance: максимальное расстояние Хэмминга между хэшами «почти такого же» кадра
+        timing_window: по скольким последним кадрам школы/камеры считать перцентили этапов
+        """
+        if not 0 < detection_scale <= 1:
+            raise ValueError("detection_scale должен быть в диапазоне (0, 1]")
+        self.tolerance = tolerance
+        self.detection_scale = detection_scale
+        self.upsample = upsample
+        self.detector = detector
+        # имя -> созданный FaceDetector (модели загружаются один раз)
+        self._detectors = {}
+        self._detectors_lock = threading.Lock()
+        self.camera_settings_loader = camera_settings_loader
+        self.camera_settings_refresh_seconds = camera_settings_refresh_seconds
+        # school_id -> (время загрузки, настройки камер школы)
+        self._camera_settings = {}
+        self._camera_settings_lock = threading.Lock()
+        self.tracking_frames = tracking_frames
+        self.tracking_iou = tracking_iou
+        self.min_face_size = min_face_size
+        self.min_sharpness = min_sharpness
+        self.max_yaw = max_yaw
+        self.frame_cache_seconds = frame_cache_seconds
+        self.frame_cache_distance = frame_cache_distance
+        # (school_id, camera_id) -> {'hash', 'faces', 'version', 'cached_at'}
+        self._frame_cache = {}
+        self._frame_cache_lock = threading.Lock()
+        self.frame_cache_stats = Counter()
+        # Замер этапов текущего кадра (у каждого потока свой) и скользящая статистика
+        self._timing_local = threading.local()
+        self.timing_stats = TimingStats(timing_window)
+        # Сколько лиц отклонено по каждой причине с запуска процесса
+        self.rejections = Counter()
+        self._rejections_lock = threading.Lock()
+        self.priority_loader = priority_loader
+        self.priority_refresh_seconds = priority_refresh_seconds
+        # school_id -> {'student_ids', 'loaded_at', 'gallery', 'base_version'}
+        self._priority = {}
+        self._priority_lock = threading.Lock()
+        # (school_id, camera_id) -> FaceTracker
+        self._trackers = {}
+        self._trackers_lock = threading.Lock()
+        self.max_galleries = max_galleries
+        self.index_threshold = index_threshold
+        self.storage = storage
+        self.gallery_loader = gallery_loader
+        self.snapshot_store = snapshot_store
+        self.changes_loader = changes_loader
+        if shared_galleries and (snapshot_store is None or fcntl is None):
+            print("[WARNING] Общие галереи требуют снимков на диске и fcntl, у каждого процесса своя копия")
+            shared_galleries = False
+        self.shared_galleries = shared_galleries
+        self.shared_check_seconds = shared_check_seconds
+        # school_id -> время последней проверки поколения снимка
+        self._shared_checked_at = {}
+        self.state_loader = state_loader
+        self.state_check_seconds = state_check_seconds
+        # school_id -> {'state', 'synced_at', 'checked_at'} - состояние БД, с которым сверена галерея
+        self._gallery_states = {}
+        # school_id -> FaceGallery; None - галерея без привязки к школе (супер-админ)
+        self._galleries = OrderedDict()
+        self._galleries_lock = threading.RLock()
     
     def extract_face_encoding(self, image_path):
         """
@@ -28,87 +1283,729 @@ class FaceRecognitionService:
             print(f"Ошибка при извлечении encoding: {e}")
             return None
     
-    def load_student_encodings(self, students):
+    def extract_face_encoding_from_bytes(self, data):
+        """
+        Извлечь face encoding из байтов изображения
+        Returns: encoding или None если лицо не найдено
+        """
+        frame = self.decode_frame(data)
+        if frame is None:
+            return None
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        encodings = face_recognition.face_encodings(rgb_frame)
+        return encodings[0] if len(encodings) > 0 else None
+    
+    def get_gallery(self, school_id=None):
+        """
+        Получить галерею школы, при необходимости загрузив её через gallery_loader.
+        Редко используемые галереи вытесняются (LRU)
+        """
+        with self._galleries_lock:
+            gallery = self._galleries.get(school_id)
+            if gallery is not None:
+                self._galleries.move_to_end(school_id)
+        if gallery is not None:
+            if self.shared_galleries:
+                return self._refresh_shared(school_id, gallery)
+            return self._refresh_stale(school_id, gallery)
+        
+        if self.gallery_loader is None:
+            gallery = FaceGallery(self.index_threshold, storage=self.storage)
+            self._store_gallery(school_id, gallery)
+            return gallery
+        
+        # Состояние читается до загрузки: изменение во время загрузки заметит следующая проверка
+        state = self._read_state(school_id)
+        gallery = self._load_snapshot(school_id)
+        if gallery is None:
+            gallery = self.reload_gallery(school_id)
+        self._remember_state(school_id, state)
+        return gallery
+    
+    def reload_gallery(self, school_id=None):
+        """
+        Полностью перечитать галерею школы через gallery_loader и обновить её снимок на диске
+        Returns: FaceGallery школы
+        """
+        with self._snapshot_lock(school_id):
+            version = time.time()
+            gallery = self.load_student_encodings(self.gallery_loader(school_id), school_id=school_id)
+            if self.snapshot_store is None or not self.snapshot_store.save(school_id, gallery, version):
+                return gallery
+            if self.shared_galleries:
+                gallery = self._attach_published(school_id, gallery)
+        return gallery
+    
+    def _snapshot_lock(self, school_id):
+        """Блокировка снимка школы между процессами (только для общих галерей)"""
+        if self.shared_galleries:
+            return self.snapshot_store.lock(school_id)
+        return nullcontext()
+    
+    def _attach_snapshot(self, snapshot):
+        """Галерея, подключённая к массивам снимка без копирования"""
+        gallery = FaceGallery(self.index_threshold, storage=self.storage, scale=snapshot['scale'])
+        gallery.attach(snapshot['matrix'], snapshot['norms'], snapshot['student_ids'], snapshot['samples'],
+                       snapshot['index'])
+        gallery.snapshot_generation = snapshot['generation']
+        return gallery
+    
+    def _attach_published(self, school_id, gallery):
+        """
+        Заменить галерею процесса только что записанным снимком, чтобы её память
+        делилась с остальными процессами. Галерея, не загруженная в этом процессе, не подключается
+        Returns: новая галерея (или прежняя, если снимок не читается)
+        """
+        with self._galleries_lock:
+            if school_id not in self._galleries:
+                return gallery
+        snapshot = self.snapshot_store.load(school_id)
+        if snapshot is None:
+            return gallery
+        published = self._attach_snapshot(snapshot)
+        with self._galleries_lock:
+            if school_id in self._galleries:
+                self._store_gallery(school_id, published)
+        self._shared_checked_at[school_id] = time.monotonic()
+        return published
+    
+    def _refresh_shared(self, school_id, gallery):
+        """Переключиться на новое поколение снимка, если его опубликовал другой процесс"""
+        now = time.monotonic()
+        if now - self._shared_checked_at.get(school_id, 0) < self.shared_check_seconds:
+            return gallery
+        self._shared_checked_at[school_id] = now
+        
+        generation = self.snapshot_store.generation(school_id)
+        if generation is None or generation == gallery.snapshot_generation:
+            return gallery
+        snapshot = self.snapshot_store.load(school_id)
+        if snapshot is None or snapshot['storage'] != self.storage:
+            return gallery
+        fresh = self._attach_snapshot(snapshot)
+        self._store_gallery(school_id, fresh)
+        return fresh
+    
+    def _read_state(self, school_id):
+        """
+        Состояние учеников школы в БД (state_loader)
+        Returns: (состояние, время чтения) или None, если сверка не нужна или не удалась
+        """
+        if self.state_loader is None or self.shared_galleries:
+            return None
+        read_at = time.time()
+        try:
+            return self.state_loader(school_id), read_at
+        except Exception as e:
+            print(f"[WARNING] Не удалось прочитать состояние галереи школы {school_id}: {e}")
+            return None
+    
+    def _remember_state(self, school_id, state):
+        """Запомнить состояние БД, с которым теперь совпадает галерея школы"""
+        if state is None:
+            return
+        self._gallery_states[school_id] = {
+            'state': state[0],
+            'synced_at': state[1],
+            'checked_at': time.monotonic(),
+        }
+    
+    def _refresh_stale(self, school_id, gallery):
+        """
+        Догрузить из БД изменения, сделанные другими процессами, если состояние школы
+        изменилось с прошлой сверки (не чаще раза в state_check_seconds)
+        """
+        entry = self._gallery_states.get(school_id)
+        if entry is None:
+            return gallery
+        now = time.monotonic()
+        if now - entry['checked_at'] < self.state_check_seconds:
+            return gallery
+        entry['checked_at'] = now
+        
+        state = self._read_state(school_id)
+        if state is None or state[0] == entry['state']:
+            return gallery
+        
+        if self.changes_loader is None:
+            gallery = self.reload_gallery(school_id)
+        else:
+            # Запас на запись, закоммиченную позже собственной отметки face_updated_at:
+            # повторный upsert неизменённого ученика безвреден
+            since = entry['synced_at'] - self.STATE_SYNC_GRACE_SECONDS
+            changed, removed = self._apply_db_changes(school_id, gallery, since)
+            print(f"Галерея школы {school_id} догружена из БД: обновлено {changed}, удалено {removed}")
+        self._remember_state(school_id, state)
+        return gallery
+    
+    def _apply_db_changes(self, school_id, gallery, since):
+        """
+        Применить к галерее изменения учеников из БД после since (changes_loader)
+        Returns: (сколько учеников обновлено, сколько удалено)
         """
-        Загрузить все encodings учеников в память
+        known_ids = set(gallery.known_student_ids)
+        active_ids, changed_students = self.changes_loader(school_id, since, known_ids)
+        
+        # Удалённые, деактивированные и перешедшие в другую школу ученики
+        removed_ids = known_ids - set(active_ids)
+        for student_id in removed_ids:
+            gallery.remove(student_id)
+        
+        for student in changed_students:
+            encoding = student.get_face_encoding()
+            if encoding is not None:
+                gallery.upsert(student.id, encoding, student.get_face_samples())
+            else:
+                gallery.remove(student.id)
+        return len(changed_students), len(removed_ids)
+    
+    def _load_snapshot(self, school_id):
+        """
+        Подключить снимок галереи с диска и догрузить из БД только изменённых после него учеников
+        Returns: FaceGallery или None, если снимка нет
+        """
+        if self.snapshot_store is None or self.changes_loader is None:
+            return None
+        with self._snapshot_lock(school_id):
+            snapshot = self.snapshot_store.load(school_id)
+            if snapshot is None or snapshot['storage'] != self.storage:
+                return None
+            
+            version = time.time()
+            gallery = self._attach_snapshot(snapshot)
+            
+            changed, removed = self._apply_db_changes(school_id, gallery, snapshot['version'])
+            
+            self._store_gallery(school_id, gallery)
+            print(f"Галерея школы {school_id} загружена из снимка: {len(gallery)} encodings, "
+                  f"из БД обновлено {changed}, удалено {removed}")
+            
+            if (changed or removed) and self.snapshot_store.save(school_id, gallery, version):
+                if self.shared_galleries:
+                    gallery = self._attach_published(school_id, gallery)
+        return gallery
+    
+    def _store_gallery(self, school_id, gallery):
+        """Положить галерею в реестр и вытеснить самые старые"""
+        with self._galleries_lock:
+            self._galleries[school_id] = gallery
+            self._galleries.move_to_end(school_id)
+            while len(self._galleries) > self.max_galleries:
+                evicted_school_id, _ = self._galleries.popitem(last=False)
+                print(f"Галерея школы {evicted_school_id} выгружена из памяти")
+    
+    def drop_gallery(self, school_id=None):
+        """Выгрузить галерею школы (будет загружена заново при следующем запросе)"""
+        with self._galleries_lock:
+            self._galleries.pop(school_id, None)
+        self._gallery_states.pop(school_id, None)
+        with self._priority_lock:
+            self._priority.pop(school_id, None)
+    
+    def apply_changes(self, school_id, changes):
+        """
+        Применить изменения галереи другого процесса (FaceGallery.changes_since) к копии
+        в этом процессе. Незагруженная галерея не трогается - она прочитает учеников из БД.
+        Общие галереи не меняются в памяти: их обновление - новое поколение снимка на диске,
+        поэтому вместо этого поколение проверяется при следующем запросе
+        """
+        if self.shared_galleries:
+            self._shared_checked_at.pop(school_id, None)
+            return
+        with self._galleries_lock:
+            gallery = self._galleries.get(school_id)
+        if gallery is None:
+            return
+        for _, student_id, encoding, samples in changes:
+            if encoding is None:
+                gallery.remove(student_id)
+            else:
+                gallery.upsert(student_id, encoding, samples)
+    
+    def load_student_encodings(self, students, school_id=None):
+        """
+        Загрузить все encodings учеников школы в память
         students: список объектов Student из БД
+        Returns: FaceGallery школы
         """
-        self.known_encodings = []
-        self.known_student_ids = []
+        encodings = []
+        student_ids = []
+        samples = {}
         
         for student in students:
             encoding = student.get_face_encoding()
             if encoding is not None:
-                self.known_encodings.append(np.array(encoding))
-                self.known_student_ids.append(student.id)
+                encodings.append(encoding)
+                student_ids.append(student.id)
+                student_samples = student.get_face_samples()
+                if student_samples is not None:
+                    samples[student.id] = student_samples
         
-        print(f"Загружено {len(self.known_encodings)} encodings учеников")
+        return self.load_encodings(student_ids, encodings, school_id, samples)
     
-    def recognize_face_from_frame(self, frame):
+    def load_encodings(self, student_ids, encodings, school_id=None, samples=None):
         """
-        Распознать лицо из видеокадра
-        frame: numpy array (BGR from OpenCV)
-        Returns: student_id или None
+        Загрузить галерею школы из готовых encodings
+        samples: student_id -> снимки (k, 128) учеников с несколькими снимками
+        Returns: FaceGallery школы
+        """
+        gallery = FaceGallery(self.index_threshold, storage=self.storage)
+        gallery.load(encodings, student_ids, samples)
+        self._store_gallery(school_id, gallery)
+        print(f"Загружено {len(gallery)} encodings учеников (школа: {school_id})")
+        return gallery
+    
+    def _loaded_galleries(self, school_id):
+        """Загруженные галереи, которые содержат учеников школы: своя и общая (None)"""
+        with self._galleries_lock:
+            keys = {school_id, None}
+            return [gallery for key, gallery in self._galleries.items() if key in keys]
+    
+    def upsert(self, student_id, encoding, school_id=None, samples=None):
+        """
+        Добавить или заменить encoding ученика без полной перезагрузки.
+        Незагруженные галереи не трогаются - они подтянут ученика из БД при загрузке
+        samples: все снимки ученика (k, 128), если их несколько; encoding - их центроид
+        """
+        if self.shared_galleries:
+            def apply(gallery):
+                gallery.upsert(student_id, encoding, samples)
+                return True
+            self._update_shared([school_id, None], apply)
+            return
+        for gallery in self._loaded_galleries(school_id):
+            gallery.upsert(student_id, encoding, samples)
+    
+    def remove(self, student_id, school_id=None):
         """
-        if len(self.known_encodings) == 0:
+        Удалить ученика из всех загруженных галерей
+        school_id: школа ученика (для общих галерей - какие снимки обновить; None - все загруженные)
+        """
+        with self._galleries_lock:
+            loaded = dict(self._galleries)
+        if self.shared_galleries:
+            keys = [school_id, None] if school_id is not None else list(loaded) + [None]
+            return self._update_shared(keys, lambda gallery: gallery.remove(student_id))
+        removed = False
+        for gallery in loaded.values():
+            removed = gallery.remove(student_id) or removed
+        return removed
+    
+    def _update_shared(self, school_ids, apply):
+        """
+        Изменить общие галереи: под межпроцессной блокировкой прочитать последний снимок,
+        применить apply(gallery) -> bool и опубликовать новое поколение.
+        Галерея без снимка на диске меняется только в памяти процесса
+        Returns: True если хотя бы одна галерея изменилась
+        """
+        changed = False
+        for school_id in dict.fromkeys(school_ids):
+            with self.snapshot_store.lock(school_id):
+                snapshot = self.snapshot_store.load(school_id)
+                if snapshot is None or snapshot['storage'] != self.storage:
+                    with self._galleries_lock:
+                        gallery = self._galleries.get(school_id)
+                    if gallery is not None:
+                        changed = apply(gallery) or changed
+                    continue
+                
+                gallery = self._attach_snapshot(snapshot)
+                if not apply(gallery):
+                    continue
+                changed = True
+                # Версия снимка не меняется: изменения БД после неё всё равно догрузятся при загрузке
+                if self.snapshot_store.save(school_id, gallery, snapshot['version']):
+                    self._attach_published(school_id, gallery)
+                    continue
+            # Снимок не записался - изменить хотя бы галерею процесса
+            with self._galleries_lock:
+                gallery = self._galleries.get(school_id)
+            if gallery is not None:
+                apply(gallery)
+        return changed
+    
+    def get_priority_gallery(self, school_id, gallery):
+        """
+        Подгалерея учеников, которых ждём сейчас (по priority_loader).
+        Список учеников пересчитывается раз в priority_refresh_seconds,
+        подгалерея пересобирается при изменении основной галереи
+        """
+        if self.priority_loader is None:
             return None
         
+        now = time.monotonic()
+        with self._priority_lock:
+            entry = self._priority.get(school_id)
+        
+        if entry is None or now - entry['loaded_at'] > self.priority_refresh_seconds:
+            try:
+                student_ids = list(self.priority_loader(school_id))
+            except Exception as e:
+                print(f"[WARNING] Could not load priority students: {e}")
+                # Ошибка запоминается до следующего обновления, чтобы не ходить в БД на каждый кадр
+                student_ids = None
+            entry = {'student_ids': student_ids, 'loaded_at': now, 'gallery': None, 'base_version': None}
+            with self._priority_lock:
+                self._priority[school_id] = entry
+        
+        if entry['student_ids'] is None:
+            return None
+        if entry['base_version'] != gallery.version:
+            entry['gallery'] = gallery.subset(entry['student_ids'])
+            entry['base_version'] = gallery.version
+        return entry['gallery']
+    
+    @contextmanager
+    def timing(self):
+        """
+        Замерять этапы обработки кадра в текущем потоке
+        Yields: StageTimer (во вложенном вызове - уже открытый)
+        """
+        timer = getattr(self._timing_local, 'timer', None)
+        if timer is not None:
+            yield timer
+            return
+        timer = StageTimer()
+        self._timing_local.timer = timer
+        try:
+            yield timer
+        finally:
+            self._timing_local.timer = None
+    
+    def current_timer(self):
+        """StageTimer текущего потока или None, если замер не ведётся"""
+        return getattr(self._timing_local, 'timer', None)
+    
+    def stage(self, name):
+        """Контекст замера этапа; без открытого timing() ничего не делает"""
+        timer = self.current_timer()
+        return timer.stage(name) if timer is not None else nullcontext()
+    
+    def record_timing(self, school_id, camera_id, timer):
+        """Учесть замеры кадра в скользящей статистике школы и камеры"""
+        if timer.stages:
+            self.timing_stats.add(school_id, camera_id, timer.as_dict())
+    
+    def get_timing_stats(self, school_id=None, all_schools=False):
+        """Перцентили этапов по школе и её камерам (см. TimingStats.get_stats)"""
+        return self.timing_stats.get_stats(school_id, all_schools)
+    
+    def _encode(self, rgb_frame, face_locations):
+        """face_encodings с замером этапа encode"""
+        with self.stage('encode'):
+            face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+        timer = self.current_timer()
+        if timer is not None:
+            timer.add('faces_encoded', len(face_encodings))
+        return face_encodings
+    
+    def match_encodings(self, face_encodings, school_id=None):
+        """
+        Сопоставить все лица кадра с галереей школы одним батчем (с замером этапа match)
+        face_encodings: список/матрица encodings лиц из кадра
+        Returns: список (student_id или None, distance или None) для каждого лица
+        """
+        if len(face_encodings) == 0:
+            return []
+        with self.stage('match'):
+            results = self._match_encodings(face_encodings, school_id)
+        timer = self.current_timer()
+        if timer is not None:
+            timer.set('gallery_size', len(self.get_gallery(school_id)))
+            timer.set_min('best_distance', min((distance for _, distance in results if distance is not None), default=None))
+        return results
+    
+    def _match_encodings(self, face_encodings, school_id=None):
+        """
+        Сопоставить все лица кадра с галереей школы одним батчем.
+        Сначала поиск в подгалерее priority_loader, полная галерея - только для лиц без совпадения
+        """
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, self.ENCODING_DIM)
+        gallery = self.get_gallery(school_id)
+        
+        priority_gallery = self.get_priority_gallery(school_id, gallery)
+        if priority_gallery is None or not 0 < len(priority_gallery) < len(gallery):
+            return gallery.match(queries, self.tolerance)
+        
+        results = priority_gallery.match(queries, self.tolerance)
+        missed = [index for index, (student_id, distance) in enumerate(results) if student_id is None]
+        if missed:
+            for index, result in zip(missed, gallery.match(queries[missed], self.tolerance)):
+                results[index] = result
+        return results
+    
+    def get_detector(self, name=None):
+        """
+        Детектор лиц по имени (по умолчанию - детектор сервиса).
+        Если детектор не создаётся (нет файлов модели), используется HOG
+        """
+        name = name or self.detector
+        with self._detectors_lock:
+            detector = self._detectors.get(name)
+            if detector is None:
+                try:
+                    detector = create_detector(name, self.upsample)
+                except (ValueError, OSError, cv2.error) as e:
+                    print(f"[WARNING] Детектор лиц {name} недоступен ({e}), используется hog")
+                    detector = create_detector('hog', self.upsample)
+                self._detectors[name] = detector
+            return detector
+    
+    def get_camera_settings(self, school_id=None, camera_id=None):
+        """Настройки камеры (детектор и т.п.) поверх настроек 'default' школы"""
+        if self.camera_settings_loader is None:
+            return {}
+        now = time.monotonic()
+        with self._camera_settings_lock:
+            cached = self._camera_settings.get(school_id)
+        if cached is None or now - cached[0] > self.camera_settings_refresh_seconds:
+            try:
+                cameras = self.camera_settings_loader(school_id) or {}
+            except Exception as e:
+                print(f"[WARNING] Не удалось загрузить настройки камер школы {school_id}: {e}")
+                cameras = cached[1] if cached is not None else {}
+            with self._camera_settings_lock:
+                self._camera_settings[school_id] = (now, cameras)
+        else:
+            cameras = cached[1]
+        
+        settings = dict(cameras.get('default') or {})
+        if camera_id is not None:
+            settings.update(cameras.get(str(camera_id)) or {})
+        return settings
+    
+    def invalidate_camera_settings(self, school_id=None):
+        """Сбросить кэш настроек камер школы (после их изменения)"""
+        with self._camera_settings_lock:
+            self._camera_settings.pop(school_id, None)
+    
+    def detect_faces(self, rgb_frame, school_id=None, camera_id=None):
+        """
+        Найти лица на кадре с учётом detection_scale детектором камеры,
+        только в областях интереса камеры (если заданы)
+        rgb_frame: numpy array (RGB)
+        Returns: список (top, right, bottom, left) в координатах полного кадра
+        """
+        settings = self.get_camera_settings(school_id, camera_id)
+        detector = self.get_detector(settings.get('detector'))
+        try:
+            rois = normalize_roi(settings.get('roi'))
+        except (ValueError, TypeError) as e:
+            print(f"[WARNING] Некорректная область интереса камеры {camera_id}: {e}")
+            rois = []
+        if not rois:
+            return self._detect_scaled(detector, rgb_frame)
+        
+        # Поиск только в областях интереса, рамки переводятся в координаты полного кадра
+        height, width = rgb_frame.shape[:2]
+        locations = []
+        for x1, y1, x2, y2 in rois:
+            left, top = int(x1 * width), int(y1 * height)
+            right, bottom = int(round(x2 * width)), int(round(y2 * height))
+            if right - left < 2 or bottom - top < 2:
+                continue
+            for location in self._detect_scaled(detector, rgb_frame[top:bottom, left:right]):
+                box = (location[0] + top, location[1] + left, location[2] + top, location[3] + left)
+                # Лицо на стыке пересекающихся областей находится дважды
+                if all(box_iou(box, other) < 0.5 for other in locations):
+                    locations.append(box)
+        return locations
+    
+    def _detect_scaled(self, detector, rgb_frame):
+        """Поиск лиц детектором на кадре, уменьшенном в detection_scale раз"""
+        scale = self.detection_scale
+        if scale >= 1:
+            return detector.detect(rgb_frame)
+        
+        small_frame = cv2.resize(rgb_frame, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        small_locations = detector.detect(small_frame)
+        
+        # Перевести рамки обратно в координаты полного кадра
+        height, width = rgb_frame.shape[:2]
+        locations = []
+        for top, right, bottom, left in small_locations:
+            locations.append((
+                max(0, int(round(top / scale))),
+                min(width, int(round(right / scale))),
+                min(height, int(round(bottom / scale))),
+                max(0, int(round(left / scale)))
+            ))
+        return locations
+    
+    def get_tracker(self, camera_id, school_id=None):
+        """Трекер лиц камеры (создаётся при первом кадре, удаляется после простоя)"""
+        key = (school_id, camera_id)
+        now = time.monotonic()
+        with self._trackers_lock:
+            for stale_key in [k for k, t in self._trackers.items() if now - t.last_seen > self.TRACKER_TTL_SECONDS]:
+                del self._trackers[stale_key]
+            tracker = self._trackers.get(key)
+            if tracker is None:
+                tracker = FaceTracker(self.tracking_iou, self.tracking_frames)
+                self._trackers[key] = tracker
+            return tracker
+    
+    def recognize_frame(self, frame, school_id=None, camera_id=None, tracker=None):
+        """
+        Найти и опознать все лица кадра
+        frame: numpy array (BGR from OpenCV)
+        school_id: поиск только в галерее этой школы
+        camera_id: включает трекинг лиц между кадрами этой камеры
+        tracker: явно переданный FaceTracker (вместо трекера по camera_id)
+        Returns: список словарей location/student_id/distance/tracked/rejected для каждого лица
+            (rejected - причина отказа от распознавания или None)
+        """
         # Конвертация BGR -> RGB
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        with self.stage('convert'):
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         
-        # Найти все лица в кадре
-        face_locations = face_recognition.face_locations(rgb_frame)
-        face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+        # Поиск лиц (возможно, на уменьшенном кадре), encoding - по полному разрешению
+        with self.stage('detect'):
+            face_locations = self.detect_faces(rgb_frame, school_id, camera_id)
+        timer = self.current_timer()
+        if timer is not None:
+            timer.add('faces_detected', len(face_locations))
+        if len(face_locations) == 0:
+            return []
         
-        for encoding in face_encodings:
-            # Сравнить с известными encodings
-            matches = face_recognition.compare_faces(self.known_encodings, encoding, tolerance=0.6)
-            face_distances = face_recognition.face_distance(self.known_encodings, encoding)
-            
-            if len(face_distances) > 0:
-                best_match_index = np.argmin(face_distances)
-                
-                if matches[best_match_index]:
-                    return self.known_student_ids[best_match_index]
+        # Мелкие, размытые и сильно повёрнутые лица не распознаются: encoding дорогой и почти всегда не совпадёт
+        with self.stage('quality'):
+            reasons = self.check_faces_quality(rgb_frame, face_locations)
+        accepted = [location for location, reason in zip(face_locations, reasons) if reason is None]
+        faces = iter(self._recognize_locations(rgb_frame, accepted, school_id, camera_id, tracker) if accepted else [])
+        return [
+            next(faces) if reason is None else
+            {'location': location, 'student_id': None, 'distance': None, 'tracked': False, 'rejected': reason}
+            for location, reason in zip(face_locations, reasons)
+        ]
+    
+    def check_face_quality(self, rgb_frame, location):
+        """
+        Дешёвая проверка лица перед encoding
+        Returns: причина отказа (REJECT_SMALL, REJECT_BLURRY, REJECT_TURNED) или None
+        """
+        top, right, bottom, left = location
+        if self.min_face_size and min(bottom - top, right - left) < self.min_face_size:
+            return self.REJECT_SMALL
+        
+        if self.min_sharpness:
+            face = rgb_frame[max(0, top):bottom, max(0, left):right]
+            if face.size == 0:
+                return self.REJECT_SMALL
+            gray = cv2.cvtColor(face, cv2.COLOR_RGB2GRAY)
+            gray = cv2.resize(gray, (self.SHARPNESS_FACE_SIZE, self.SHARPNESS_FACE_SIZE), interpolation=cv2.INTER_AREA)
+            if cv2.Laplacian(gray, cv2.CV_64F).var() < self.min_sharpness:
+                return self.REJECT_BLURRY
+        
+        if self.max_yaw:
+            landmarks = face_recognition.face_landmarks(rgb_frame, [location], model='small')
+            if landmarks and estimate_yaw(landmarks[0]) > self.max_yaw:
+                return self.REJECT_TURNED
+        
+        return None
+    
+    def check_faces_quality(self, rgb_frame, face_locations):
+        """Проверить все лица кадра и учесть отказы в счётчиках. Returns: список причин или None"""
+        if not (self.min_face_size or self.min_sharpness or self.max_yaw):
+            return [None] * len(face_locations)
+        reasons = [self.check_face_quality(rgb_frame, location) for location in face_locations]
+        self.record_rejections(Counter(reason for reason in reasons if reason is not None))
+        return reasons
+    
+    def record_rejections(self, counts):
+        """Добавить отказы {причина: число} в счётчики сервиса"""
+        if counts:
+            with self._rejections_lock:
+                self.rejections.update(counts)
+    
+    def get_rejection_stats(self):
+        """Сколько лиц отклонено по каждой причине с запуска процесса"""
+        with self._rejections_lock:
+            return dict(self.rejections)
+    
+    @staticmethod
+    def count_rejections(faces):
+        """Сколько лиц результата recognize_frame отклонено по каждой причине"""
+        return dict(Counter(face['rejected'] for face in faces if face.get('rejected')))
+    
+    def _recognize_locations(self, rgb_frame, face_locations, school_id, camera_id, tracker):
+        """Encoding и сопоставление лиц, прошедших проверку качества"""
+        if tracker is None and camera_id is not None and self.tracking_frames > 0:
+            tracker = self.get_tracker(camera_id, school_id)
+        
+        if tracker is not None:
+            with tracker.lock:
+                return self._recognize_tracked(rgb_frame, face_locations, school_id, tracker)
+        
+        face_encodings = self._encode(rgb_frame, face_locations)
+        matches = self.match_encodings(face_encodings, school_id)
+        return [
+            {'location': location, 'student_id': student_id, 'distance': distance, 'tracked': False, 'rejected': None}
+            for location, (student_id, distance) in zip(face_locations, matches)
+        ]
+    
+    def _recognize_tracked(self, rgb_frame, face_locations, school_id, tracker):
+        """Encoding только для рамок, не совпавших с опознанными треками"""
+        assigned = tracker.assign(face_locations)
+        results = [
+            (track['student_id'], track['distance']) if track is not None else None
+            for track in assigned
+        ]
+        
+        pending = [index for index, result in enumerate(results) if result is None]
+        if pending:
+            face_encodings = self._encode(rgb_frame, [face_locations[index] for index in pending])
+            for index, match in zip(pending, self.match_encodings(face_encodings, school_id)):
+                results[index] = match
+        
+        tracker.update(face_locations, results, assigned)
+        return [
+            {'location': location, 'student_id': student_id, 'distance': distance, 'tracked': track is not None,
+             'rejected': None}
+            for location, (student_id, distance), track in zip(face_locations, results, assigned)
+        ]
+    
+    def recognize_face_from_frame(self, frame, school_id=None, camera_id=None):
+        """
+        Распознать лицо из видеокадра
+        frame: numpy array (BGR from OpenCV)
+        school_id: поиск только в галерее этой школы
+        camera_id: трекинг лиц между кадрами этой камеры (опционально)
+        Returns: student_id или None
+        """
+        if len(self.get_gallery(school_id)) == 0:
+            return None
+        
+        for face in self.recognize_frame(frame, school_id, camera_id):
+            if face['student_id'] is not None:
+                return face['student_id']
         
         return None
     
-    def recognize_multiple_faces_from_frame(self, frame):
+    def recognize_multiple_faces_from_frame(self, frame, school_id=None, camera_id=None):
         """
         Распознать несколько лиц из видеокадра
         frame: numpy array (BGR from OpenCV)
+        school_id: поиск только в галерее этой школы
+        camera_id: трекинг лиц между кадрами этой камеры (опционально)
         Returns: список словарей с информацией о распознанных учениках
         """
-        if len(self.known_encodings) == 0:
+        if len(self.get_gallery(school_id)) == 0:
             return []
         
-        # Конвертация BGR -> RGB
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        
-        # Найти все лица в кадре
-        face_locations = face_recognition.face_locations(rgb_frame)
-        face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
-        
         recognized_students = []
         
-        for encoding, location in zip(face_encodings, face_locations):
-            # Сравнить с известными encodings
-            matches = face_recognition.compare_faces(self.known_encodings, encoding, tolerance=0.6)
-            face_distances = face_recognition.face_distance(self.known_encodings, encoding)
-            
-            if len(face_distances) > 0:
-                best_match_index = np.argmin(face_distances)
-                
-                if matches[best_match_index]:
-                    student_id = self.known_student_ids[best_match_index]
-                    recognized_students.append({
-                        'student_id': student_id,
-                        'location': location  # (top, right, bottom, left)
-                    })
+        for face in self.recognize_frame(frame, school_id, camera_id):
+            if face['student_id'] is not None:
+                recognized_students.append({
+                    'student_id': face['student_id'],
+                    'distance': face['distance'],
+                    'location': face['location']  # (top, right, bottom, left)
+                })
         
         return recognized_students
     
-    def recognize_face_from_image(self, image_path):
+    def recognize_face_from_image(self, image_path, school_id=None):
         """
         Распознать лицо из файла изображения
         Returns: student_id или None
@@ -117,12 +2014,12 @@ class FaceRecognitionService:
             frame = cv2.imread(image_path)
             if frame is None:
                 return None
-            return self.recognize_face_from_frame(frame)
+            return self.recognize_face_from_frame(frame, school_id)
         except Exception as e:
             print(f"Ошибка при распознавании: {e}")
             return None
     
-    def recognize_multiple_faces_from_image(self, image_path):
+    def recognize_multiple_faces_from_image(self, image_path, school_id=None):
         """
         Распознать несколько лиц из файла изображения
         Returns: список student_id
@@ -131,7 +2028,169 @@ class FaceRecognitionService:
             frame = cv2.imread(image_path)
             if frame is None:
                 return []
-            return self.recognize_multiple_faces_from_frame(frame)
+            return self.recognize_multiple_faces_from_frame(frame, school_id)
+        except Exception as e:
+            print(f"Ошибка при распознавании: {e}")
+            return []
+    
+    def decode_frame(self, data):
+        """
+        Декодировать JPEG/PNG кадр прямо из памяти, без записи на диск
+        data: bytes или file-like объект (например, FileStorage из Flask)
+        Returns: numpy array (BGR) или None
+        """
+        if hasattr(data, 'read'):
+            data = data.read()
+        if not data:
+            return None
+        with self.stage('decode'):
+            buffer = np.frombuffer(data, dtype=np.uint8)
+            return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    
+    def recognize_bytes(self, data, school_id=None, camera_id=None, tracker=None, frame_cache=True):
+        """
+        Найти и опознать все лица в байтах изображения
+        frame_cache: переиспользовать результат почти такого же кадра камеры (см. frame_cache_seconds)
+        Returns: список словарей как у recognize_frame
+        """
+        if len(self.get_gallery(school_id)) == 0:
+            return []
+        
+        data_hash = None
+        if frame_cache:
+            data_hash, cached_faces = self.lookup_frame_cache(data, school_id, camera_id)
+            if cached_faces is not None:
+                return cached_faces
+        
+        frame = self.decode_frame(data)
+        if frame is None:
+            return []
+        faces = self.recognize_frame(frame, school_id, camera_id, tracker=tracker)
+        if data_hash is not None:
+            self.store_frame_cache(school_id, camera_id, data_hash, faces)
+        return faces
+    
+    def hash_frame(self, data):
+        """
+        Перцептивный хэш кадра из байтов JPEG/PNG или numpy array (BGR).
+        JPEG декодируется сразу в уменьшенном в 4 раза сером виде - это в разы дешевле полного декодирования
+        Returns: int или None, если кадр не декодируется
+        """
+        if isinstance(data, np.ndarray):
+            gray = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)
+        else:
+            if not data:
+                return None
+            gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+            if gray is None:
+                return None
+        return frame_hash(gray)
+    
+    def lookup_frame_cache(self, data, school_id=None, camera_id=None):
+        """
+        Найти результат почти такого же кадра этой камеры
+        Returns: (хэш кадра или None, если кэш не применяется; список лиц из кэша или None)
+        """
+        if self.frame_cache_seconds <= 0 or camera_id is None:
+            return None, None
+        with self.stage('hash'):
+            data_hash = self.hash_frame(data)
+        if data_hash is None:
+            return None, None
+        
+        version = self.get_gallery(school_id).version
+        now = time.monotonic()
+        with self._frame_cache_lock:
+            entry = self._frame_cache.get((school_id, camera_id))
+            # Кэш сравнивается с кадром, по которому получен результат, а не с предыдущим:
+            # медленное изменение сцены не растягивает старый результат
+            if (entry is not None and entry['version'] == version
+                    and now - entry['cached_at'] <= self.frame_cache_seconds
+                    and hamming_distance(entry['hash'], data_hash) <= self.frame_cache_distance):
+                self.frame_cache_stats['hits'] += 1
+                timer = self.current_timer()
+                if timer is not None:
+                    timer.add('cache_hits')
+                return data_hash, [dict(face) for face in entry['faces']]
+            self.frame_cache_stats['misses'] += 1
+        return data_hash, None
+    
+    def store_frame_cache(self, school_id, camera_id, data_hash, faces):
+        """Запомнить результат кадра камеры для почти таких же следующих кадров"""
+        if self.frame_cache_seconds <= 0 or camera_id is None or data_hash is None:
+            return
+        version = self.get_gallery(school_id).version
+        now = time.monotonic()
+        with self._frame_cache_lock:
+            for stale_key in [k for k, e in self._frame_cache.items() if now - e['cached_at'] > self.frame_cache_seconds]:
+                del self._frame_cache[stale_key]
+            self._frame_cache[(school_id, camera_id)] = {
+                'hash': data_hash,
+                'faces': [dict(face) for face in faces],
+                'version': version,
+                'cached_at': now,
+            }
+    
+    def recognize_chips(self, chips, school_id=None):
+        """
+        Опознать готовые вырезки лиц (например, 150x150 от детектора на стороне клиента)
+        без поиска лиц на сервере.
+        Контракт вырезки: квадрат со стороной CHIP_MARGIN x сторона рамки лица, лицо по центру.
+        encoding считается по известной рамке - центральной части вырезки без запаса (~11.5% с
+        каждой стороны), т.е. по той же рамке, что даёт детектор при записи лица и в целом кадре
+        chips: список bytes (JPEG/PNG) или numpy array (BGR)
+        Returns: список словарей student_id/distance для каждой вырезки (None - не декодировалась)
+        """
+        rgb_chips = []
+        indexes = []
+        for index, chip in enumerate(chips):
+            frame = chip if isinstance(chip, np.ndarray) else self.decode_frame(chip)
+            if frame is None or min(frame.shape[:2]) < self.MIN_CHIP_SIZE:
+                continue
+            with self.stage('convert'):
+                rgb_chips.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            indexes.append(index)
+        
+        results = [{'student_id': None, 'distance': None} for _ in chips]
+        if not rgb_chips or len(self.get_gallery(school_id)) == 0:
+            return results
+        
+        face_encodings = []
+        for rgb_chip in rgb_chips:
+            height, width = rgb_chip.shape[:2]
+            # Запас вырезки по краям: рамка лица - центральная часть со стороной 1 / CHIP_MARGIN
+            inset = (1 - 1 / self.CHIP_MARGIN) / 2
+            top, left = int(round(height * inset)), int(round(width * inset))
+            face_encodings.extend(self._encode(rgb_chip, [(top, width - left, height - top, left)]))
+        
+        for index, (student_id, distance) in zip(indexes, self.match_encodings(face_encodings, school_id)):
+            results[index] = {'student_id': student_id, 'distance': distance}
+        return results
+    
+    def recognize_face_from_bytes(self, data, school_id=None, camera_id=None):
+        """
+        Распознать лицо из байтов изображения
+        Returns: student_id или None
+        """
+        try:
+            frame = self.decode_frame(data)
+            if frame is None:
+                return None
+            return self.recognize_face_from_frame(frame, school_id, camera_id)
+        except Exception as e:
+            print(f"Ошибка при распознавании: {e}")
+            return None
+    
+    def recognize_multiple_faces_from_bytes(self, data, school_id=None, camera_id=None):
+        """
+        Распознать несколько лиц из байтов изображения
+        Returns: список словарей с информацией о распознанных учениках
+        """
+        try:
+            frame = self.decode_frame(data)
+            if frame is None:
+                return []
+            return self.recognize_multiple_faces_from_frame(frame, school_id, camera_id)
         except Exception as e:
             print(f"Ошибка при распознавании: {e}")
             return []
@@ -152,3 +2211,149 @@ class FaceRecognitionService:
         
         # Вернуть путь с прямыми слэшами для URL
         return filepath.replace('\\', '/')
+
+
+# ===== РЕЖИМ ДОЛГОЖИВУЩЕГО ВОРКЕРА =====
+#
+# python face_service.py - процесс читает команды JSON-lines из stdin и отвечает
+# JSON-lines в stdout; галереи остаются в памяти между вызовами.
+# Запрос:  {"id": 1, "cmd": "recognize", "image": "<base64 jpeg>", "school_id": 1}
+# Ответ:   {"id": 1, "ok": true, "result": {...}} или {"id": 1, "ok": false, "error": "..."}
+# Encodings передаются как base64 от 512 байт float32 (или списком из 128 чисел).
+
+def decode_encoding(value):
+    """Encoding из base64 (512 байт float32) или списка чисел"""
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def encode_encoding(encoding):
+    """Encoding в base64 от 512 байт float32"""
+    return base64.b64encode(np.asarray(encoding, dtype=np.float32).tobytes()).decode('ascii')
+
+
+def _worker_health(service, request):
+    with service._galleries_lock:
+        galleries = {str(school_id): len(gallery) for school_id, gallery in service._galleries.items()}
+    return {'status': 'ok', 'pid': os.getpid(), 'galleries': galleries}
+
+
+def decode_samples(samples):
+    """Список base64 снимков ученика -> матрица (k, 128) или None"""
+    if not samples:
+        return None
+    return np.vstack([decode_encoding(sample) for sample in samples])
+
+
+def _worker_load_gallery(service, request):
+    students = request.get('students', [])
+    student_ids = [student['id'] for student in students]
+    encodings = [decode_encoding(student['encoding']) for student in students]
+    samples = {
+        student['id']: decode_samples(student['samples'])
+        for student in students if student.get('samples')
+    }
+    gallery = service.load_encodings(student_ids, encodings, request.get('school_id'), samples)
+    return {'loaded': len(gallery)}
+
+
+def _worker_upsert(service, request):
+    service.upsert(
+        request['student_id'], decode_encoding(request['encoding']), request.get('school_id'),
+        decode_samples(request.get('samples'))
+    )
+    return {'student_id': request['student_id']}
+
+
+def _worker_remove(service, request):
+    return {'removed': service.remove(request['student_id'])}
+
+
+def _worker_recognize_chips(service, request):
+    chips = [base64.b64decode(chip) for chip in request.get('chips', [])]
+    return {'faces': service.recognize_chips(chips, request.get('school_id'))}
+
+
+def _worker_recognize(service, request):
+    data = base64.b64decode(request['image'])
+    with service.timing() as timer:
+        faces = service.recognize_bytes(data, request.get('school_id'), request.get('camera_id'))
+    service.record_timing(request.get('school_id'), request.get('camera_id'), timer)
+    return {'timings': timer.as_dict(), 'faces': [
+        {
+            'student_id': face['student_id'],
+            'distance': face['distance'],
+            'location': list(face['location']),
+            'tracked': face['tracked'],
+            'rejected': face.get('rejected')
+        }
+        for face in faces
+    ]}
+
+
+def _worker_encode(service, request):
+    encoding = service.extract_face_encoding_from_bytes(base64.b64decode(request['image']))
+    return {'encoding': encode_encoding(encoding) if encoding is not None else None}
+
+
+WORKER_COMMANDS = {
+    'health': _worker_health,
+    'load_gallery': _worker_load_gallery,
+    'upsert': _worker_upsert,
+    'remove': _worker_remove,
+    'recognize': _worker_recognize,
+    'recognize_chips': _worker_recognize_chips,
+    'encode': _worker_encode,
+}
+
+
+def run_worker(service, stdin, stdout):
+    """Цикл обработки команд JSON-lines до EOF или команды shutdown"""
+    for line in stdin:
+        line = line.strip()
+        if not line:
+            continue
+        
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            cmd = request.get('cmd')
+            if cmd == 'shutdown':
+                response = {'id': request_id, 'ok': True, 'result': None}
+                stdout.write(json.dumps(response) + '\n')
+                stdout.flush()
+                break
+            handler = WORKER_COMMANDS.get(cmd)
+            if handler is None:
+                raise ValueError(f"Неизвестная команда: {cmd}")
+            response = {'id': request_id, 'ok': True, 'result': handler(service, request)}
+        except Exception as e:
+            response = {'id': request_id, 'ok': False, 'error': str(e)}
+        
+        stdout.write(json.dumps(response, ensure_ascii=False) + '\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    # stdout занят протоколом - служебный вывод (print) уходит в stderr
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+    
+    worker_service = FaceRecognitionService(
+        tolerance=float(os.environ.get('FACE_TOLERANCE', 0.6)),
+        detection_scale=float(os.environ.get('FACE_DETECTION_SCALE', 1.0)),
+        upsample=int(os.environ.get('FACE_DETECTION_UPSAMPLE', 1)),
+        tracking_frames=int(os.environ.get('FACE_TRACKING_FRAMES', 0)),
+        index_threshold=int(os.environ.get('FACE_INDEX_THRESHOLD', 20000)),
+        storage=os.environ.get('FACE_GALLERY_STORAGE', 'float32'),
+        detector=os.environ.get('FACE_DETECTOR', 'hog'),
+        min_face_size=int(os.environ.get('FACE_MIN_FACE_SIZE', 0)),
+        min_sharpness=float(os.environ.get('FACE_MIN_SHARPNESS', 0)),
+        max_yaw=float(os.environ.get('FACE_MAX_YAW', 0)),
+        frame_cache_seconds=float(os.environ.get('FACE_FRAME_CACHE_SECONDS', 0)),
+        frame_cache_distance=int(os.environ.get('FACE_FRAME_CACHE_DISTANCE', 4)),
+        timing_window=int(os.environ.get('FACE_TIMING_WINDOW', 500))
+    )
+    run_worker(worker_service, sys.stdin, protocol_out)
@@ -1,16 +1,30 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, make_response
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_bcrypt import Bcrypt
 from werkzeug.utils import secure_filename
 import os
-import face_recognition
+import json
+from functools import wraps
 from datetime import datetime, timedelta, time, date, timezone
 from sqlalchemy import func
 import pytz
 
-from backend.models.models import db, User, Student, Payment, Attendance, Expense, Group, Tariff, ClubSettings, RewardType, StudentReward, CashTransfer, Role, RolePermission, CardType, StudentCard, School, SchoolFeature, SuperAdmin
-from backend.services.face_service import FaceRecognitionService
+from backend.models.models import db, decode_face_encoding, User, Student, Payment, Attendance, Expense, Group, Tariff, ClubSettings, RewardType, StudentReward, CashTransfer, Role, RolePermission, CardType, StudentCard, School, SchoolFeature, SuperAdmin
+from backend.services.face_service import FaceRecognitionService, GallerySnapshotStore, DETECTORS, normalize_roi
+from backend.services.face_pool import (
+    FaceRecognitionPool,
+    FaceRecognitionStream,
+    FaceRecognitionTimeout,
+    FaceRecognitionBusy,
+    FaceRecognitionSuperseded
+)
 from backend.data.locations import get_cities, get_districts
+
+try:
+    from flask_sock import Sock
+except ImportError:
+    # Без flask-sock страница камеры работает через HTTP-запросы /api/recognize_multiple
+    Sock = None
 from backend.utils.student_utils import (
     generate_telegram_link_code,
     get_next_available_student_number,
@@ -75,7 +89,200 @@ bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
-face_service = FaceRecognitionService()
+def load_face_gallery_students(school_id):
+    """Активные ученики школы для ленивой загрузки галереи face encodings"""
+    students_query = Student.query.filter_by(status='active')
+    if school_id:
+        students_query = students_query.filter_by(school_id=school_id)
+    return students_query.all()
+
+
+def load_face_gallery_changes(school_id, since, known_ids):
+    """
+    Догрузка галереи к снимку с диска: читаются только id и время изменения encoding,
+    полные строки - только для учеников, изменённых после since или отсутствующих в снимке
+    Returns: (id активных учеников с encoding, список изменённых Student)
+    """
+    since_datetime = datetime.fromtimestamp(since, TASHKENT_TZ).replace(tzinfo=None)
+    rows_query = db.session.query(Student.id, Student.face_updated_at).filter(
+        Student.status == 'active',
+        Student.face_encoding.isnot(None)
+    )
+    if school_id:
+        rows_query = rows_query.filter(Student.school_id == school_id)
+    rows = rows_query.all()
+    
+    active_ids = [row.id for row in rows]
+    changed_ids = [
+        row.id for row in rows
+        if row.id not in known_ids or (row.face_updated_at is not None and row.face_updated_at >= since_datetime)
+    ]
+    
+    changed_students = []
+    for start in range(0, len(changed_ids), 500):
+        changed_students.extend(Student.query.filter(Student.id.in_(changed_ids[start:start + 500])).all())
+    return active_ids, changed_students
+
+
+def load_face_gallery_state(school_id):
+    """
+    Состояние галереи школы в БД: число активных учеников с encoding и последнее изменение encoding.
+    По нему процесс замечает upsert/remove, выполненные другими воркерами gunicorn
+    """
+    state_query = db.session.query(db.func.count(Student.id), db.func.max(Student.face_updated_at)).filter(
+        Student.status == 'active',
+        Student.face_encoding.isnot(None)
+    )
+    if school_id:
+        state_query = state_query.filter(Student.school_id == school_id)
+    count, updated_at = state_query.one()
+    return count, updated_at
+
+
+def load_face_camera_settings(school_id):
+    """Настройки камер Face ID школы из настроек клуба"""
+    if not school_id:
+        return {}
+    settings = ClubSettings.query.filter_by(school_id=school_id).first()
+    return settings.get_face_cameras() if settings else {}
+
+
+def load_face_priority_student_ids(school_id):
+    """
+    Ученики групп, у которых занятие начинается в пределах окна от текущего времени.
+    Их encodings сравниваются первыми (основная масса отметок - незадолго до начала занятия)
+    """
+    window = int(os.environ.get('FACE_PRIORITY_WINDOW_MINUTES', 45))
+    now = get_local_time()
+    now_minutes = now.hour * 60 + now.minute
+    today = now.isoweekday()
+    
+    groups_query = Group.query
+    if school_id:
+        groups_query = groups_query.filter_by(school_id=school_id)
+    
+    group_ids = []
+    for group in groups_query.all():
+        schedule_days = group.get_schedule_days_list()
+        start_minutes = group.schedule_time.hour * 60 + group.schedule_time.minute
+        # Окно может переходить через полночь: проверяются вчерашнее, сегодняшнее и завтрашнее занятия
+        for day_offset in (-1, 0, 1):
+            weekday = (today - 1 + day_offset) % 7 + 1
+            if weekday in schedule_days and abs(start_minutes + day_offset * 24 * 60 - now_minutes) <= window:
+                group_ids.append(group.id)
+                break
+    
+    if not group_ids:
+        return []
+    
+    rows = db.session.query(Student.id).filter(
+        Student.group_id.in_(group_ids),
+        Student.status == 'active'
+    ).all()
+    return [row.id for row in rows]
+
+
+FACE_SERVICE_OPTIONS = {
+    'max_galleries': int(os.environ.get('FACE_MAX_GALLERIES', 32)),
+    'detection_scale': float(os.environ.get('FACE_DETECTION_SCALE', 1.0)),
+    'upsample': int(os.environ.get('FACE_DETECTION_UPSAMPLE', 1)),
+    'tracking_frames': int(os.environ.get('FACE_TRACKING_FRAMES', 0)),
+    'priority_refresh_seconds': int(os.environ.get('FACE_PRIORITY_REFRESH_SECONDS', 60)),
+    'index_threshold': int(os.environ.get('FACE_INDEX_THRESHOLD', 20000)),
+    'storage': os.environ.get('FACE_GALLERY_STORAGE', 'float32'),
+    'shared_galleries': os.environ.get('FACE_SHARED_GALLERY', '0') == '1',
+    'state_check_seconds': float(os.environ.get('FACE_GALLERY_CHECK_SECONDS', 10)),
+    'detector': os.environ.get('FACE_DETECTOR', 'hog'),
+    'min_face_size': int(os.environ.get('FACE_MIN_FACE_SIZE', 48)),
+    'min_sharpness': float(os.environ.get('FACE_MIN_SHARPNESS', 0)),
+    'max_yaw': float(os.environ.get('FACE_MAX_YAW', 0)),
+    'frame_cache_seconds': float(os.environ.get('FACE_FRAME_CACHE_SECONDS', 2)),
+    'frame_cache_distance': int(os.environ.get('FACE_FRAME_CACHE_DISTANCE', 4)),
+    'timing_window': int(os.environ.get('FACE_TIMING_WINDOW', 500)),
+}
+
+# Снимки галерей на диске для быстрого старта (пустая FACE_SNAPSHOT_DIR - выключено)
+FACE_SNAPSHOT_DIR = os.environ.get('FACE_SNAPSHOT_DIR', os.path.join(basedir, 'database', 'face_snapshots'))
+face_snapshot_store = GallerySnapshotStore(FACE_SNAPSHOT_DIR) if FACE_SNAPSHOT_DIR else None
+
+face_service = FaceRecognitionService(
+    gallery_loader=load_face_gallery_students,
+    priority_loader=load_face_priority_student_ids,
+    snapshot_store=face_snapshot_store,
+    changes_loader=load_face_gallery_changes,
+    state_loader=load_face_gallery_state,
+    camera_settings_loader=load_face_camera_settings,
+    **FACE_SERVICE_OPTIONS
+)
+
+
+def init_face_worker():
+    """Инициализация процесса распознавания: соединения с БД не делятся с родителем"""
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def load_face_gallery_students_in_worker(school_id):
+    """Загрузка галереи в процессе распознавания (вне контекста запроса)"""
+    with app.app_context():
+        return load_face_gallery_students(school_id)
+
+
+def load_face_gallery_changes_in_worker(school_id, since, known_ids):
+    """Догрузка галереи к снимку в процессе распознавания (вне контекста запроса)"""
+    with app.app_context():
+        return load_face_gallery_changes(school_id, since, known_ids)
+
+
+def load_face_camera_settings_in_worker(school_id):
+    """Настройки камер в процессе распознавания (вне контекста запроса)"""
+    with app.app_context():
+        return load_face_camera_settings(school_id)
+
+
+def load_face_priority_student_ids_in_worker(school_id):
+    """Список приоритетных учеников в процессе распознавания (вне контекста запроса)"""
+    with app.app_context():
+        return load_face_priority_student_ids(school_id)
+
+
+def create_worker_face_service():
+    """
+    FaceRecognitionService процесса распознавания с собственной копией галерей.
+    Копия догоняет основной процесс по его журналу изменений, поэтому состояние БД не сверяет
+    """
+    return FaceRecognitionService(
+        gallery_loader=load_face_gallery_students_in_worker,
+        priority_loader=load_face_priority_student_ids_in_worker,
+        snapshot_store=face_snapshot_store,
+        changes_loader=load_face_gallery_changes_in_worker,
+        camera_settings_loader=load_face_camera_settings_in_worker,
+        **FACE_SERVICE_OPTIONS
+    )
+
+
+# Самый большой кадр, принимаемый потоковым каналом распознавания
+FACE_STREAM_MAX_FRAME_BYTES = 2 * 1024 * 1024
+
+face_pool = FaceRecognitionPool(
+    face_service,
+    create_worker_face_service,
+    processes=int(os.environ.get('FACE_WORKER_PROCESSES', 0)),
+    timeout=float(os.environ.get('FACE_RECOGNITION_TIMEOUT', 10)),
+    worker_init=init_face_worker,
+    max_active=int(os.environ.get('FACE_MAX_ACTIVE', 0)),
+    admission_wait=float(os.environ.get('FACE_ADMISSION_WAIT', 1.0))
+)
+
+# Пауза между кадрами потокового канала. Без пула процессов кадр распознаётся в потоке gunicorn
+# и держит GIL, поэтому частота остаётся как у HTTP-запросов страницы камеры (раз в 2 с)
+FACE_STREAM_FRAME_DELAY_MS = int(os.environ.get(
+    'FACE_STREAM_FRAME_DELAY_MS', 300 if face_pool.processes > 0 else 2000
+))
+
+# WebSocket для потокового распознавания со страницы камеры (/ws/recognize)
+app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': 25, 'max_message_size': FACE_STREAM_MAX_FRAME_BYTES}
+sock = Sock(app) if Sock is not None else None
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -317,6 +524,8 @@ def ensure_club_settings_columns():
             conn.execute(db.text("ALTER TABLE club_settings ADD COLUMN telegram_payment_template TEXT"))
         if 'notification_hours_before' not in columns:
             conn.execute(db.text("ALTER TABLE club_settings ADD COLUMN notification_hours_before INTEGER"))
+        if 'face_cameras' not in columns:
+            conn.execute(db.text("ALTER TABLE club_settings ADD COLUMN face_cameras TEXT"))
 
 
 def ensure_students_columns():
@@ -360,10 +569,83 @@ def ensure_students_columns():
                 except Exception as e:
                     if "duplicate column" not in str(e).lower() and "already exists" not in str(e).lower():
                         print(f"Ошибка при добавлении telegram_notifications_enabled: {e}")
+            
+            if 'face_samples' not in student_columns:
+                try:
+                    binary_type = 'BYTEA' if db.engine.dialect.name == 'postgresql' else 'BLOB'
+                    conn.execute(db.text(f"ALTER TABLE students ADD COLUMN face_samples {binary_type}"))
+                    print("✓ Добавлена колонка face_samples в таблицу students")
+                except Exception as e:
+                    if "duplicate column" not in str(e).lower() and "already exists" not in str(e).lower():
+                        print(f"Ошибка при добавлении face_samples: {e}")
+            
+            if 'face_updated_at' not in student_columns:
+                try:
+                    conn.execute(db.text("ALTER TABLE students ADD COLUMN face_updated_at TIMESTAMP"))
+                    print("✓ Добавлена колонка face_updated_at в таблицу students")
+                except Exception as e:
+                    if "duplicate column" not in str(e).lower() and "already exists" not in str(e).lower():
+                        print(f"Ошибка при добавлении face_updated_at: {e}")
     except Exception as e:
         print(f"Ошибка при миграции таблицы students: {e}")
         import traceback
         traceback.print_exc()
+    
+    try:
+        ensure_face_encoding_column()
+    except Exception as e:
+        print(f"Ошибка при конвертации students.face_encoding: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+def ensure_face_encoding_column():
+    """
+    Переводит students.face_encoding из JSON-текста в бинарную колонку (512 байт float32).
+    Значения, которые не удалось разобрать, обнуляются - ученику нужно заново снять лицо
+    """
+    inspector = db.inspect(db.engine)
+    columns = {col['name']: col for col in inspector.get_columns('students')}
+    binary_type = 'BYTEA' if db.engine.dialect.name == 'postgresql' else 'BLOB'
+    
+    if 'face_encoding' in columns:
+        column_type = str(columns['face_encoding']['type']).upper()
+        if any(name in column_type for name in ('BYTEA', 'BLOB', 'BINARY')):
+            return
+    
+    with db.engine.begin() as conn:
+        if 'face_encoding' not in columns:
+            conn.execute(db.text(f"ALTER TABLE students ADD COLUMN face_encoding {binary_type}"))
+            print(f"✓ Добавлена колонка face_encoding ({binary_type}) в таблицу students")
+            return
+        
+        print("Конвертация students.face_encoding в бинарный формат...")
+        if 'face_encoding_bin' not in columns:
+            conn.execute(db.text(f"ALTER TABLE students ADD COLUMN face_encoding_bin {binary_type}"))
+        
+        rows = conn.execute(db.text(
+            "SELECT id, face_encoding FROM students WHERE face_encoding IS NOT NULL"
+        )).fetchall()
+        converted = 0
+        skipped = 0
+        for student_id, value in rows:
+            try:
+                encoding = decode_face_encoding(value)
+            except (ValueError, TypeError) as e:
+                print(f"[WARNING] Ученик {student_id}: не удалось разобрать face encoding ({e})")
+                encoding = None
+            if encoding is None:
+                skipped += 1
+                continue
+            conn.execute(
+                db.text("UPDATE students SET face_encoding_bin = :data WHERE id = :id"),
+                {'data': encoding.tobytes(), 'id': student_id}
+            )
+            converted += 1
+        
+        conn.execute(db.text("ALTER TABLE students DROP COLUMN face_encoding"))
+        conn.execute(db.text("ALTER TABLE students RENAME COLUMN face_encoding_bin TO face_encoding"))
+        print(f"✓ Колонка face_encoding теперь {binary_type}: сконвертировано {converted}, пропущено {skipped}")
 
 
 def ensure_cash_transfers_table():
@@ -515,6 +797,45 @@ def calculate_student_balance(student):
     return balance
 
 
+def calculate_students_balances(students):
+    """
+    Балансы нескольких учеников (как calculate_student_balance) за три запроса на всех
+    Returns: {student_id: (баланс, считается ли баланс по посещениям)};
+        если по посещениям, каждая новая отметка уменьшает баланс на 1
+    """
+    students = list(students)
+    if not students:
+        return {}
+    student_ids = [student.id for student in students]
+    
+    # Стоимость одного занятия по тарифам учеников
+    lesson_prices = {}
+    tariff_ids = {student.tariff_id for student in students if student.tariff_id}
+    if tariff_ids:
+        tariff_query = Tariff.query.filter(Tariff.id.in_(list(tariff_ids)))
+        for tariff in filter_query_by_school(tariff_query, Tariff).all():
+            if tariff.price and tariff.lessons_count and tariff.lessons_count > 0:
+                lesson_prices[tariff.id] = float(tariff.price) / float(tariff.lessons_count)
+    
+    total_paid = dict(db.session.query(Payment.student_id, db.func.sum(Payment.amount_paid)).filter(
+        Payment.student_id.in_(student_ids)
+    ).group_by(Payment.student_id).all())
+    attendance_counts = dict(db.session.query(Attendance.student_id, db.func.count(Attendance.id)).filter(
+        Attendance.student_id.in_(student_ids)
+    ).group_by(Attendance.student_id).all())
+    
+    balances = {}
+    for student in students:
+        lesson_price = lesson_prices.get(student.tariff_id, 0)
+        if lesson_price <= 0:
+            # Если тариф не задан или некорректный - старый баланс
+            balances[student.id] = (student.balance if student.balance else 0, False)
+            continue
+        paid_lessons = int((total_paid.get(student.id) or 0) / lesson_price)
+        balances[student.id] = (paid_lessons - attendance_counts.get(student.id, 0), True)
+    return balances
+
+
 def parse_days_list(raw_days):
     if raw_days is None:
         return []
@@ -933,8 +1254,8 @@ def add_student():
         
         db.session.commit()
         
-        # Перезагрузить encodings
-        reload_face_encodings()
+        # Добавить encoding ученика в галерею
+        sync_student_face_encoding(student)
         
         return jsonify({'success': True, 'student_id': student.id, 'student_number': student_number})
     
@@ -1023,6 +1344,9 @@ def update_student(student_id):
     try:
         student_query = Student.query.filter_by(id=student_id)
         student = filter_query_by_school(student_query, Student).first_or_404()
+        # Для галереи Face ID важны только фото (encoding) и статус (в т.ч. чёрный список)
+        old_status = student.status
+        old_face_encoding = student.face_encoding
         
         # Определить группу для валидации
         current_group_id = student.group_id
@@ -1146,19 +1470,24 @@ def update_student(student_id):
                 student.photo_path = photo_path
                 
                 # Создать новый face encoding
-                try:
-                    image = face_recognition.load_image_file(photo_path)
-                    encodings = face_recognition.face_encodings(image)
-                    if encodings:
-                        student.face_encoding = encodings[0].tobytes()
-                        reload_face_encodings()
-                except Exception as e:
-                    print(f"Ошибка обработки фото: {e}")
+                encoding = face_service.extract_face_encoding(photo_path)
+                if encoding is not None:
+                    student.set_face_encoding(encoding)
+        
+        # Смена статуса меняет состав галереи: остальные процессы заметят её по face_updated_at
+        if student.status != old_status:
+            student.face_updated_at = get_local_datetime()
         
         # Убедиться, что у ученика есть код для Telegram
         ensure_student_has_telegram_code(student)
         
         db.session.commit()
+        
+        # Обновить галерею только при новом фото, смене статуса или чёрном списке: правка
+        # телефона или размера формы не должна сбрасывать кэши и переписывать снимки галереи
+        if student.status != old_status or student.face_encoding != old_face_encoding:
+            sync_student_face_encoding(student)
+        
         return jsonify({'success': True})
     
     except Exception as e:
@@ -1173,6 +1502,7 @@ def delete_student(student_id):
         student_query = Student.query.filter_by(id=student_id)
         student = filter_query_by_school(student_query, Student).first_or_404()
         student_name = student.full_name
+        student_school_id = student.school_id
         
         # Удалить все связанные записи перед удалением ученика
         # 1. Удалить карточки ученика
@@ -1202,8 +1532,8 @@ def delete_student(student_id):
         db.session.delete(student)
         db.session.commit()
         
-        # Перезагрузить encodings
-        reload_face_encodings()
+        # Убрать ученика из галереи
+        face_service.remove(student_id, student_school_id)
         
         return jsonify({'success': True, 'message': f'Ученик {student_name} удалён'})
     
@@ -1213,6 +1543,37 @@ def delete_student(student_id):
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+@app.route('/api/students/<int:student_id>/face_samples', methods=['POST'])
+@login_required
+def add_student_face_sample(student_id):
+    """
+    Добавить ученику ещё один снимок лица (другое освещение, ракурс).
+    Галерея сравнивает кадр с центроидом снимков, затем с каждым снимком ближайших учеников
+    """
+    try:
+        student_query = Student.query.filter_by(id=student_id)
+        student = filter_query_by_school(student_query, Student).first_or_404()
+        
+        photo = request.files.get('photo')
+        if not photo or not photo.filename:
+            return jsonify({'success': False, 'message': 'Фото не загружено'}), 400
+        
+        encoding = face_service.extract_face_encoding_from_bytes(photo.read())
+        if encoding is None:
+            return jsonify({'success': False, 'message': 'Лицо на фото не найдено'}), 400
+        
+        samples_count = student.add_face_sample(encoding)
+        db.session.commit()
+        
+        sync_student_face_encoding(student)
+        
+        return jsonify({'success': True, 'samples': samples_count})
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
 # ===== ПЛАТЕЖИ =====
 
 @app.route('/api/payments/add', methods=['POST'])
@@ -2591,6 +2952,74 @@ def update_club_settings():
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+def validate_face_camera_settings(cameras):
+    """
+    Проверить настройки камер Face ID: {camera_id или 'default': {'detector': ..., 'roi': ...}}
+    Returns: (очищенные настройки, сообщение об ошибке или None)
+    """
+    if not isinstance(cameras, dict):
+        return None, 'Некорректный формат настроек камер'
+    
+    cleaned = {}
+    for camera_id, camera in cameras.items():
+        if not isinstance(camera, dict):
+            return None, f'Некорректные настройки камеры {camera_id}'
+        camera_settings = {}
+        detector = camera.get('detector')
+        if detector:
+            if detector not in DETECTORS:
+                return None, f'Неизвестный детектор лиц: {detector}'
+            camera_settings['detector'] = detector
+        roi = camera.get('roi')
+        if roi:
+            try:
+                camera_settings['roi'] = [list(rectangle) for rectangle in normalize_roi(roi)]
+            except (ValueError, TypeError) as e:
+                return None, f'Камера {camera_id}: {e}'
+        if camera_settings:
+            cleaned[str(camera_id)] = camera_settings
+    return cleaned, None
+
+
+@app.route('/api/club-settings/face-cameras', methods=['GET'])
+@login_required
+def get_face_camera_settings():
+    """Настройки камер Face ID текущей школы"""
+    school_id = get_current_school_id()
+    return jsonify({
+        'cameras': load_face_camera_settings(school_id),
+        'detectors': list(DETECTORS)
+    })
+
+
+@app.route('/api/club-settings/face-cameras', methods=['PUT'])
+@login_required
+def update_face_camera_settings():
+    """Сохранить настройки камер Face ID текущей школы (детектор лиц и области интереса камер)"""
+    school_id = get_current_school_id()
+    if not school_id:
+        return jsonify({'success': False, 'message': 'Школа не выбрана'}), 400
+    
+    try:
+        data = request.get_json() or {}
+        cameras, error = validate_face_camera_settings(data.get('cameras', {}))
+        if error:
+            return jsonify({'success': False, 'message': error}), 400
+        
+        settings = ClubSettings.query.filter_by(school_id=school_id).first()
+        if not settings:
+            settings = ClubSettings(school_id=school_id)
+            db.session.add(settings)
+        settings.set_face_cameras(cameras)
+        db.session.commit()
+        
+        face_service.invalidate_camera_settings(school_id)
+        return jsonify({'success': True, 'cameras': cameras})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
 @app.route('/api/groups/add', methods=['POST'])
 @login_required
 def add_group():
@@ -3788,8 +4217,12 @@ def get_districts_list(city):
 @login_required
 def camera_page():
     """Страница с камерой для распознавания"""
-    # Перезагрузить encodings для текущей школы при загрузке страницы
-    reload_face_encodings()
+    # Подготовить галерею школы к первому кадру: из памяти или снимка на диске,
+    # из БД догружаются только изменённые ученики
+    try:
+        face_service.get_gallery(get_current_school_id())
+    except Exception as e:
+        print(f"[WARNING] Could not load face gallery: {e}")
     return render_template('camera.html')
 
 
@@ -4511,7 +4944,31 @@ def delete_cash_transfer(transfer_id):
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+# Отдавать замеры этапов распознавания в заголовке Server-Timing (видно в DevTools браузера)
+FACE_TIMING_HEADERS = os.environ.get('FACE_TIMING_HEADERS') == '1'
+
+
+def face_timed(view):
+    """
+    Замер этапов распознавания запроса (decode, detect, encode, match, db...):
+    скользящая статистика по школе и камере и, при FACE_TIMING_HEADERS, заголовок Server-Timing
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with face_service.timing() as timer:
+            with timer.stage('total'):
+                response = make_response(view(*args, **kwargs))
+        # Запросы, не дошедшие до распознавания (нет изображения и т.п.), не учитываются
+        if len(timer.stages) > 1:
+            face_service.record_timing(get_current_school_id(), request.form.get('camera_id'), timer)
+            if FACE_TIMING_HEADERS:
+                response.headers['Server-Timing'] = timer.server_timing()
+        return response
+    return wrapper
+
+
 @app.route('/api/recognize', methods=['POST'])
+@face_timed
 def recognize_face():
     """Распознать лицо из кадра камеры"""
     try:
@@ -4520,15 +4977,15 @@ def recognize_face():
         # Получить изображение (base64 или файл)
         if 'image' in request.files:
             image_file = request.files['image']
-            temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_recognize.jpg')
-            image_file.save(temp_path)
-            
-            student_id = face_service.recognize_face_from_image(temp_path)
-            os.remove(temp_path)
+            camera_id = request.form.get('camera_id')
+            faces = face_pool.recognize(image_file.read(), school_id, camera_id)
+            student_id = next((face['student_id'] for face in faces if face['student_id'] is not None), None)
             
             if student_id:
-                student_query = Student.query.filter_by(id=student_id)
-                student = filter_query_by_school(student_query, Student).first()
+                with face_service.stage('db'):
+                    student_query = Student.query.filter_by(id=student_id)
+                    student = filter_query_by_school(student_query, Student).first()
+                    balance = calculate_student_balance(student) if student else None
                 if not student:
                     return jsonify({'success': False, 'message': 'Студент не найден в текущей школе'}), 403
                 
@@ -4536,19 +4993,25 @@ def recognize_face():
                     'success': True,
                     'student_id': student.id,
                     'student_name': student.full_name,
-                    'balance': calculate_student_balance(student),
-                    'photo': student.photo_path
+                    'balance': balance,
+                    'photo': student.photo_path,
+                    'rejected': FaceRecognitionService.count_rejections(faces)
                 })
             else:
-                return jsonify({'success': False, 'message': 'Лицо не распознано'})
+                return face_rejection_response(faces)
         
         return jsonify({'success': False, 'message': 'Нет изображения'}), 400
     
+    except FaceRecognitionSuperseded:
+        return jsonify({'success': False, 'busy': True, 'superseded': True, 'message': 'Кадр заменён более новым'}), 503
+    except (FaceRecognitionTimeout, FaceRecognitionBusy):
+        return jsonify({'success': False, 'busy': True, 'message': 'Сервер распознавания занят'}), 503
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
 @app.route('/api/recognize_multiple', methods=['POST'])
+@face_timed
 def recognize_multiple_faces():
     """Распознать несколько лиц из кадра камеры"""
     try:
@@ -4556,62 +5019,323 @@ def recognize_multiple_faces():
         
         if 'image' in request.files:
             image_file = request.files['image']
-            temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_recognize.jpg')
-            image_file.save(temp_path)
-            
-            recognized = face_service.recognize_multiple_faces_from_image(temp_path)
-            os.remove(temp_path)
+            camera_id = request.form.get('camera_id')
+            faces = face_pool.recognize(image_file.read(), school_id, camera_id)
+            recognized = [face for face in faces if face['student_id'] is not None]
             
             if len(recognized) > 0:
-                students_data = []
-                for item in recognized:
-                    student_query = Student.query.filter_by(id=item['student_id'])
-                    student = filter_query_by_school(student_query, Student).first()
-                    # Фильтруем только студентов текущей школы
-                    if student:
-                        students_data.append({
-                            'student_id': student.id,
-                            'student_name': student.full_name,
-                            'balance': calculate_student_balance(student),
-                            'photo': student.photo_path
-                        })
+                with face_service.stage('db'):
+                    students_data = face_students_data(face['student_id'] for face in recognized)
                 
                 return jsonify({
                     'success': True,
                     'count': len(students_data),
-                    'students': students_data
+                    'students': students_data,
+                    'rejected': FaceRecognitionService.count_rejections(faces)
                 })
             else:
-                return jsonify({'success': False, 'message': 'Лица не распознаны'})
+                return face_rejection_response(faces)
         
         return jsonify({'success': False, 'message': 'Нет изображения'}), 400
     
+    except FaceRecognitionSuperseded:
+        return jsonify({'success': False, 'busy': True, 'superseded': True, 'message': 'Кадр заменён более новым'}), 503
+    except (FaceRecognitionTimeout, FaceRecognitionBusy):
+        return jsonify({'success': False, 'busy': True, 'message': 'Сервер распознавания занят'}), 503
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
-def reload_face_encodings(school_id=None):
-    """Перезагрузить все face encodings в память для текущей школы"""
+# Сколько вырезок лиц принимать в одном запросе /api/recognize_chips
+FACE_MAX_CHIPS = 16
+
+
+@app.route('/api/recognize_chips', methods=['POST'])
+@face_timed
+def recognize_face_chips():
+    """
+    Опознать вырезки лиц, найденные детектором на стороне клиента (файлы chips, ~150x150).
+    Сервер не ищет лица на кадре, а только считает encoding и сравнивает с галереей
+    """
     try:
-        # Пытаемся получить school_id из контекста запроса, если он доступен
-        if school_id is None:
-            try:
-                school_id = get_current_school_id()
-            except RuntimeError:
-                # Работаем вне контекста запроса (например, при инициализации)
-                school_id = None
+        school_id = get_current_school_id()
         
-        if school_id:
-            students_query = Student.query.filter_by(status='active', school_id=school_id)
-            students = filter_query_by_school(students_query, Student).all()
+        chip_files = request.files.getlist('chips')[:FACE_MAX_CHIPS]
+        if not chip_files:
+            return jsonify({'success': False, 'message': 'Нет изображений лиц'}), 400
+        
+        faces = face_pool.recognize_chips([chip_file.read() for chip_file in chip_files], school_id)
+        with face_service.stage('db'):
+            students_data = face_students_data(face['student_id'] for face in faces if face['student_id'] is not None)
+        
+        if not students_data:
+            return jsonify({'success': False, 'message': 'Лица не распознаны'})
+        
+        return jsonify({
+            'success': True,
+            'count': len(students_data),
+            'students': students_data
+        })
+    
+    except FaceRecognitionSuperseded:
+        return jsonify({'success': False, 'busy': True, 'superseded': True, 'message': 'Кадр заменён более новым'}), 503
+    except (FaceRecognitionTimeout, FaceRecognitionBusy):
+        return jsonify({'success': False, 'busy': True, 'message': 'Сервер распознавания занят'}), 503
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/api/recognize_checkin', methods=['POST'])
+@face_timed
+def recognize_and_checkin():
+    """
+    Распознать кадр (файл image) или вырезки лиц (файлы chips) и сразу отметить приход
+    всех опознанных учеников школы. Заменяет /api/recognize_multiple и отдельный
+    /api/attendance/checkin для каждого ученика: один запрос и одна транзакция
+    """
+    try:
+        school_id = get_current_school_id()
+        
+        if 'image' in request.files:
+            camera_id = request.form.get('camera_id')
+            faces = face_pool.recognize(request.files['image'].read(), school_id, camera_id)
         else:
-            # Если школа не выбрана (например, для супер-админа или при инициализации), загружаем всех
-            students_query = Student.query.filter_by(status='active')
-            students = filter_query_by_school(students_query, Student).all()
-        face_service.load_student_encodings(students)
+            chip_files = request.files.getlist('chips')[:FACE_MAX_CHIPS]
+            if not chip_files:
+                return jsonify({'success': False, 'message': 'Нет изображения'}), 400
+            faces = face_pool.recognize_chips([chip_file.read() for chip_file in chip_files], school_id)
+        
+        with face_service.stage('db'):
+            results = checkin_recognized_students(face['student_id'] for face in faces if face['student_id'] is not None)
+        if not results:
+            return face_rejection_response(faces)
+        
+        return jsonify({
+            'success': True,
+            'count': len(results),
+            'students': results,
+            'rejected': FaceRecognitionService.count_rejections(faces)
+        })
+    
+    except FaceRecognitionSuperseded:
+        return jsonify({'success': False, 'busy': True, 'superseded': True, 'message': 'Кадр заменён более новым'}), 503
+    except (FaceRecognitionTimeout, FaceRecognitionBusy):
+        return jsonify({'success': False, 'busy': True, 'message': 'Сервер распознавания занят'}), 503
     except Exception as e:
-        # Игнорируем ошибки при инициализации, если нет активных запросов
-        print(f"[WARNING] Could not reload face encodings: {e}")
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+if sock is not None:
+    @sock.route('/ws/recognize')
+    def recognize_stream(ws):
+        """
+        Потоковое распознавание для страницы камеры: одно соединение на киоск.
+        Клиент шлёт кадры (JPEG, бинарные сообщения), сервер на каждый кадр отвечает
+        JSON-событием {type: result|busy, frame, faces, students, rejected, message}.
+        Первое событие {type: hello, frame_delay_ms} задаёт паузу между кадрами клиента.
+        Ученики, впервые появившиеся в кадре этого соединения, сразу отмечаются;
+        students - результаты отметки как у /api/recognize_checkin.
+        Следующий кадр клиент шлёт после ответа на предыдущий
+        """
+        if not current_user.is_authenticated:
+            ws.close(1008, 'Требуется вход')
+            return
+        
+        school_id = get_current_school_id()
+        stream = FaceRecognitionStream(face_pool, school_id, request.args.get('camera_id'))
+        db.session.remove()
+        ws.send(json.dumps({'type': 'hello', 'frame_delay_ms': FACE_STREAM_FRAME_DELAY_MS}))
+        
+        while True:
+            data = ws.receive()
+            if not isinstance(data, (bytes, bytearray)):
+                # Текстовые сообщения (например, ping клиента) не обрабатываются
+                continue
+            
+            with face_service.timing() as timer:
+                with timer.stage('total'):
+                    try:
+                        faces, appeared = stream.process(bytes(data))
+                    except (FaceRecognitionTimeout, FaceRecognitionBusy):
+                        faces = None
+                    else:
+                        try:
+                            with timer.stage('db'):
+                                students_data = checkin_recognized_students(appeared)
+                        finally:
+                            # Соединение живёт долго: не держать сессию БД и устаревшие данные между кадрами
+                            db.session.remove()
+            
+            if faces is None:
+                ws.send(json.dumps({'type': 'busy', 'frame': stream.frames, 'message': 'Сервер распознавания занят'}))
+                continue
+            
+            face_service.record_timing(school_id, stream.camera_id, timer)
+            rejected = FaceRecognitionService.count_rejections(faces)
+            event = {
+                'type': 'result',
+                'frame': stream.frames,
+                'faces': len(faces),
+                'students': students_data,
+                'rejected': rejected,
+                'message': face_rejection_hint(rejected) if not any(face['student_id'] for face in faces) else None
+            }
+            if FACE_TIMING_HEADERS:
+                event['timings'] = timer.as_dict()
+            ws.send(json.dumps(event, ensure_ascii=False))
+
+
+@app.route('/api/face-stats', methods=['GET'])
+@login_required
+def get_face_stats():
+    """
+    Статистика распознавания этого процесса: перцентили этапов по школе и камерам,
+    отказы проверки качества, кэш кадров, допуск кадров.
+    У каждого процесса gunicorn своя статистика (pid в ответе)
+    """
+    from backend.middleware.school_middleware import is_super_admin
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'timings': face_service.get_timing_stats(get_current_school_id(), all_schools=is_super_admin()),
+        'rejections': face_service.get_rejection_stats(),
+        'frame_cache': dict(face_service.frame_cache_stats),
+        'admission': face_pool.admission.get_stats()
+    })
+
+
+# Подсказки для киоска по причинам отказа от распознавания лица
+FACE_REJECTION_HINTS = {
+    FaceRecognitionService.REJECT_SMALL: 'Подойдите ближе к камере',
+    FaceRecognitionService.REJECT_BLURRY: 'Постойте неподвижно перед камерой',
+    FaceRecognitionService.REJECT_TURNED: 'Посмотрите прямо в камеру',
+}
+
+
+def face_rejection_hint(rejected):
+    """Подсказка по самой частой причине отказа {причина: число} или None"""
+    if not rejected:
+        return None
+    return FACE_REJECTION_HINTS[max(rejected, key=rejected.get)]
+
+
+def face_rejection_response(faces):
+    """Ответ, когда никто не опознан: с подсказкой, если лица отклонены проверкой качества"""
+    rejected = FaceRecognitionService.count_rejections(faces)
+    return jsonify({
+        'success': False,
+        'message': face_rejection_hint(rejected) or 'Лица не распознаны',
+        'rejected': rejected
+    })
+
+
+def face_students_data(student_ids):
+    """Данные опознанных учеников текущей школы для ответа API (повторы и чужие ученики отбрасываются)"""
+    students_data = []
+    for student_id in dict.fromkeys(student_ids):
+        student_query = Student.query.filter_by(id=student_id)
+        student = filter_query_by_school(student_query, Student).first()
+        # Фильтруем только студентов текущей школы
+        if student:
+            students_data.append({
+                'student_id': student.id,
+                'student_name': student.full_name,
+                'balance': calculate_student_balance(student),
+                'photo': student.photo_path
+            })
+    return students_data
+
+
+def checkin_recognized_students(student_ids):
+    """
+    Отметить приход опознанных учеников текущей школы одной транзакцией.
+    Те же правила, что у /api/attendance/checkin, но ученики, отметки за сегодня, балансы
+    и группы загружаются одним запросом на всех, а не несколькими на каждого ученика
+    Returns: список результатов по ученикам: status checked_in / already_checked_in,
+        баланс до и после отметки, low_balance, is_late, late_minutes
+    """
+    student_ids = list(dict.fromkeys(student_ids))
+    if not student_ids:
+        return []
+    
+    student_query = Student.query.filter(Student.id.in_(student_ids))
+    students = {student.id: student for student in filter_query_by_school(student_query, Student).all()}
+    students = [students[student_id] for student_id in student_ids if student_id in students]
+    if not students:
+        return []
+    
+    today = get_local_date()
+    now = get_local_datetime()
+    
+    # Ученики уже отфильтрованы по школе, поэтому отметки ищем просто по их id
+    already = {row.student_id for row in db.session.query(Attendance.student_id).filter(
+        Attendance.student_id.in_([student.id for student in students]),
+        Attendance.date == today
+    ).all()}
+    balances = calculate_students_balances(students)
+    
+    group_ids = {student.group_id for student in students if student.group_id and student.id not in already}
+    groups = {group.id: group for group in Group.query.filter(Group.id.in_(list(group_ids))).all()} if group_ids else {}
+    
+    results = []
+    try:
+        for student in students:
+            balance, counts_attendance = balances[student.id]
+            result = {
+                'student_id': student.id,
+                'student_name': student.full_name,
+                'photo': student.photo_path,
+                'club_funded': student.club_funded,
+                'balance': balance,
+                'remaining_balance': balance,
+                'low_balance': False,
+                'is_late': False,
+                'late_minutes': 0,
+            }
+            results.append(result)
+            
+            if student.id in already:
+                result['status'] = 'already_checked_in'
+                continue
+            
+            # Проверка баланса: пропускаем даже при нуле/минусе, админ решает
+            result['low_balance'] = (not student.club_funded and balance <= 0)
+            
+            # Определить опоздание
+            group = groups.get(student.group_id)
+            if group and group.schedule_time:
+                scheduled_time = datetime.combine(today, group.schedule_time)
+                time_diff = (now - scheduled_time).total_seconds() / 60
+                if time_diff > group.late_threshold:
+                    result['is_late'] = True
+                    result['late_minutes'] = int(time_diff)
+            
+            db.session.add(Attendance(
+                student_id=student.id,
+                date=today,
+                lesson_deducted=not student.club_funded,
+                is_late=result['is_late'],
+                late_minutes=result['late_minutes']
+            ))
+            result['status'] = 'checked_in'
+            if counts_attendance:
+                result['remaining_balance'] = balance - 1
+        
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return results
+
+
+def sync_student_face_encoding(student):
+    """Обновить encoding одного ученика в галерее без полной перезагрузки"""
+    encoding = student.get_face_encoding() if student.status == 'active' else None
+    if encoding is not None:
+        face_service.upsert(student.id, encoding, student.school_id, student.get_face_samples())
+    else:
+        face_service.remove(student.id, student.school_id)
 
 
 # ===== ИНИЦИАЛИЗАЦИЯ =====
@@ -4650,8 +5374,8 @@ def init_db():
             db.session.commit()
             print(f"✓ Сгенерированы коды Telegram для {len(students_without_code)} учеников")
         
-        # Загрузить encodings
-        reload_face_encodings()
+        # Галереи face encodings загружаются лениво при первом запросе распознавания школы
+        # (из снимка на диске, если он есть, с догрузкой изменённых учеников из БД)
 
 
 # ===== ПОМЕСЯЧНЫЕ ОПЛАТЫ =====
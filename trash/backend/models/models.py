@@ -2,6 +2,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime, time
 import json
+import numpy as np
 import pytz
 
 # Часовой пояс Ташкента (UTC+5)
@@ -17,6 +18,52 @@ def get_local_date():
 
 db = SQLAlchemy()
 
+# Face encoding хранится как 128 значений float32 (512 байт)
+FACE_ENCODING_DIM = 128
+FACE_ENCODING_BYTES = FACE_ENCODING_DIM * 4
+# Сколько снимков лица хранить на ученика
+FACE_MAX_SAMPLES = 10
+
+def decode_face_encoding(value):
+    """
+    Привести значение колонки students.face_encoding к numpy array float32 (128,).
+    Кроме 512 байт float32 понимает старые форматы, которые встречаются до миграции:
+    JSON-строку, сырые float64 байты и bytea в hex-виде ('\\x...'), записанный в TEXT колонку
+    Returns: numpy array или None, если encoding нет
+    Raises: ValueError, если значение не разобрать
+    """
+    if value is None:
+        return None
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+        if not value.startswith('\\x'):
+            return _decode_json_encoding(value)
+        value = bytes.fromhex(value[2:])
+    value = bytes(value)
+    if not value:
+        return None
+    if len(value) == FACE_ENCODING_BYTES:
+        return np.frombuffer(value, dtype=np.float32)
+    if len(value) == FACE_ENCODING_BYTES * 2:
+        # Сырые float64 байты, записанные старым кодом редактирования ученика
+        return np.frombuffer(value, dtype=np.float64).astype(np.float32)
+    if value[:1] == b'[':
+        return _decode_json_encoding(value.decode('utf-8'))
+    raise ValueError(f"неизвестный формат face encoding ({len(value)} байт)")
+
+
+def _decode_json_encoding(text):
+    """Старый формат: JSON-список из 128 чисел"""
+    encoding = np.asarray(json.loads(text), dtype=np.float32)
+    if encoding.size != FACE_ENCODING_DIM:
+        raise ValueError(f"в face encoding {encoding.size} значений вместо {FACE_ENCODING_DIM}")
+    return encoding.reshape(FACE_ENCODING_DIM)
+
+
 class User(UserMixin, db.Model):
     """Пользователи системы (администратор, финансист)"""
     __tablename__ = 'users'
@@ -193,7 +240,9 @@ class Student(db.Model):
     phone = db.Column(db.String(20))
     parent_phone = db.Column(db.String(20))
     photo_path = db.Column(db.String(300))
-    face_encoding = db.Column(db.Text)  # JSON строка с encoding лица
+    face_encoding = db.Column(db.LargeBinary)  # 128 x float32 (512 байт) encoding лица
+    face_samples = db.Column(db.LargeBinary)  # k x 128 float32 снимков лица; face_encoding - их центроид
+    face_updated_at = db.Column(db.DateTime)  # Когда менялся face_encoding (догрузка к снимку галереи)
     balance = db.Column(db.Integer, default=0)  # Оставшиеся занятия
     tariff_type = db.Column(db.String(50))  # Например: "8 занятий"
     tariff_id = db.Column(db.Integer, db.ForeignKey('tariffs.id'), nullable=True)  # Связь с тарифом
@@ -245,15 +294,47 @@ class Student(db.Model):
     tariff = db.relationship('Tariff', backref='students', lazy=True)
     
     def get_face_encoding(self):
-        """Получить face encoding как numpy array"""
-        if self.face_encoding:
-            return json.loads(self.face_encoding)
-        return None
+        """Получить face encoding как numpy array float32 (128,) или None"""
+        try:
+            return decode_face_encoding(self.face_encoding)
+        except (ValueError, TypeError) as e:
+            # Битое значение не должно ломать загрузку галереи всей школы
+            print(f"[WARNING] Не удалось разобрать face encoding ученика {self.id}: {e}")
+            return None
     
     def set_face_encoding(self, encoding):
-        """Сохранить face encoding"""
+        """Сохранить face encoding как 512 байт float32 (заменяет все дополнительные снимки)"""
         if encoding is not None:
-            self.face_encoding = json.dumps(encoding.tolist())
+            self.face_encoding = np.asarray(encoding, dtype=np.float32).reshape(FACE_ENCODING_DIM).tobytes()
+            self.face_samples = None
+            self.face_updated_at = get_local_datetime()
+    
+    def get_face_samples(self):
+        """Все снимки лица как numpy array (k, 128) или None, если снимок один"""
+        if not self.face_samples:
+            return None
+        samples = np.frombuffer(bytes(self.face_samples), dtype=np.float32)
+        if len(samples) % FACE_ENCODING_DIM:
+            return None
+        return samples.reshape(-1, FACE_ENCODING_DIM)
+    
+    def add_face_sample(self, encoding, max_samples=FACE_MAX_SAMPLES):
+        """
+        Добавить снимок лица. Хранятся последние max_samples снимков,
+        в face_encoding записывается их центроид (по нему идёт первый этап поиска)
+        Returns: число снимков ученика
+        """
+        samples = self.get_face_samples()
+        if samples is None:
+            current = self.get_face_encoding()
+            samples = current.reshape(1, FACE_ENCODING_DIM) if current is not None else np.empty((0, FACE_ENCODING_DIM), dtype=np.float32)
+        encoding = np.asarray(encoding, dtype=np.float32).reshape(1, FACE_ENCODING_DIM)
+        samples = np.vstack([samples, encoding])[-max_samples:]
+        
+        self.face_encoding = samples.mean(axis=0).astype(np.float32).tobytes()
+        self.face_samples = samples.tobytes() if len(samples) > 1 else None
+        self.face_updated_at = get_local_datetime()
+        return len(samples)
     
     def __repr__(self):
         return f'<Student {self.full_name}>'
@@ -340,6 +421,7 @@ class ClubSettings(db.Model):
     telegram_payment_template = db.Column(db.Text, nullable=True)  # Шаблон уведомления об оплате
     notification_hours_before = db.Column(db.Integer, nullable=True)  # За сколько часов до занятия отправлять уведомление (1-5)
     school_id = db.Column(db.Integer, db.ForeignKey('schools.id'), nullable=True, unique=True)  # Привязка к школе (один к одному)
+    face_cameras = db.Column(db.Text, nullable=True)  # JSON настроек камер Face ID: {camera_id: {"detector": ..., "roi": ...}}
 
     def get_working_days_list(self):
         if self.working_days:
@@ -349,6 +431,19 @@ class ClubSettings(db.Model):
     def set_working_days_list(self, days_list):
         self.working_days = ','.join(map(str, sorted(days_list)))
 
+    def get_face_cameras(self):
+        """Настройки камер Face ID как словарь (ключ 'default' - для всех камер)"""
+        if self.face_cameras:
+            try:
+                return json.loads(self.face_cameras)
+            except ValueError:
+                return {}
+        return {}
+
+    def set_face_cameras(self, cameras):
+        """Сохранить настройки камер Face ID как JSON"""
+        self.face_cameras = json.dumps(cameras, ensure_ascii=False) if cameras else None
+
 
 class RewardType(db.Model):
     """Типы вознаграждений"""
@@ -0,0 +1,435 @@
+"""
+Пул процессов для распознавания лиц.
+
+dlib держит GIL на сотни миллисекунд при поиске лиц и encoding, поэтому кадры
+обрабатываются в отдельных процессах, а поток запроса только ждёт результат.
+Каждый процесс держит свою копию галерей. Изменения галереи в основном процессе
+(upsert/remove) передаются вместе с задачей и применяются к копии; галерея
+перечитывается из БД, только если журнал изменений уже не покрывает её версию.
+"""
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from backend.services.face_service import FaceTracker
+
+
+class FaceRecognitionTimeout(Exception):
+    """Распознавание не уложилось в отведённое время"""
+
+
+class FaceRecognitionBusy(Exception):
+    """Кадр не допущен к распознаванию: все слоты заняты дольше допустимого ожидания"""
+
+
+class FaceRecognitionSuperseded(FaceRecognitionBusy):
+    """Кадр не дождался распознавания: камера уже прислала более новый"""
+
+
+# Состояние процесса-воркера
+_worker_service = None
+# school_id -> версия галереи основного процесса, с которой синхронизирована копия воркера
+_worker_versions = {}
+
+
+def _init_worker(service_factory, worker_init):
+    """Инициализация процесса-воркера"""
+    global _worker_service
+    if worker_init is not None:
+        worker_init()
+    _worker_service = service_factory()
+    _worker_versions.clear()
+
+
+def _sync_worker_gallery(school_id, sync):
+    """
+    Догнать копию галереи школы до версии основного процесса
+    sync: (версия галереи, since, изменения после since) - как у FaceRecognitionPool._gallery_sync
+    """
+    version, since, changes = sync
+    synced = _worker_versions.get(school_id)
+    if synced == version:
+        return
+    if synced is not None:
+        if since <= synced or _worker_service.shared_galleries:
+            _worker_service.apply_changes(school_id, [change for change in changes if change[0] > synced])
+        else:
+            # Журнал основного процесса не помнит изменений после нашей версии - перечитать галерею из БД
+            _worker_service.drop_gallery(school_id)
+    _worker_versions[school_id] = version
+
+
+def _recognize_in_worker(data, school_id, camera_id, sync, tracks, tracking_iou, tracking_frames):
+    """
+    Распознать кадр в процессе-воркере
+    Returns: (список лиц как у recognize_frame, обновлённые треки камеры или None,
+        замеры этапов StageTimer.as_dict, pid воркера)
+    """
+    _sync_worker_gallery(school_id, sync)
+    
+    with _worker_service.timing() as timer:
+        frame = _worker_service.decode_frame(data)
+        if frame is None:
+            return [], tracks, timer.as_dict(), os.getpid()
+        
+        tracker = None
+        if tracks is not None:
+            tracker = FaceTracker(tracking_iou, tracking_frames)
+            tracker.tracks = tracks
+        
+        faces = _worker_service.recognize_frame(frame, school_id, camera_id, tracker=tracker)
+    return faces, tracker.tracks if tracker is not None else None, timer.as_dict(), os.getpid()
+
+
+def _recognize_chips_in_worker(chips, school_id, sync):
+    """Опознать вырезки лиц в процессе-воркере. Returns: (результаты вырезок, замеры этапов, pid воркера)"""
+    _sync_worker_gallery(school_id, sync)
+    with _worker_service.timing() as timer:
+        results = _worker_service.recognize_chips(chips, school_id)
+    return results, timer.as_dict(), os.getpid()
+
+
+class FaceAdmission:
+    """
+    Допуск кадров к распознаванию.
+    Одновременно распознаётся не больше max_active кадров, у каждой камеры - не больше одного.
+    Каждая камера держит в очереди только последний кадр: новый кадр вытесняет ждущий
+    (побеждает последний кадр), а кадр, не получивший слот за wait_seconds, отклоняется.
+    Так задержка остаётся ограниченной, когда вся группа приходит одновременно
+    """
+    
+    def __init__(self, max_active=1, wait_seconds=1.0):
+        self.max_active = max(1, max_active)
+        self.wait_seconds = wait_seconds
+        self._condition = threading.Condition()
+        self._active = 0
+        # Камеры, кадр которых сейчас распознаётся
+        self._running = set()
+        # Камера -> номер последнего пришедшего кадра
+        self._latest = {}
+        self._tickets = itertools.count()
+        self.stats = {'admitted': 0, 'superseded': 0, 'busy': 0}
+    
+    @contextmanager
+    def admit(self, camera_key=None):
+        """
+        Дождаться слота для кадра камеры camera_key (None - кадр без камеры)
+        Raises: FaceRecognitionSuperseded, FaceRecognitionBusy
+        """
+        ticket = next(self._tickets)
+        deadline = time.monotonic() + self.wait_seconds
+        with self._condition:
+            if camera_key is not None:
+                self._latest[camera_key] = ticket
+                # Разбудить ждущий кадр этой камеры: он больше не нужен
+                self._condition.notify_all()
+            
+            while True:
+                if camera_key is not None and self._latest.get(camera_key) != ticket:
+                    self.stats['superseded'] += 1
+                    raise FaceRecognitionSuperseded('Камера прислала более новый кадр')
+                if self._active < self.max_active and camera_key not in self._running:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if camera_key is not None:
+                        del self._latest[camera_key]
+                    self.stats['busy'] += 1
+                    raise FaceRecognitionBusy('Сервер распознавания занят')
+                self._condition.wait(remaining)
+            
+            self._active += 1
+            self.stats['admitted'] += 1
+            if camera_key is not None:
+                self._running.add(camera_key)
+                del self._latest[camera_key]
+        
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._running.discard(camera_key)
+                self._condition.notify_all()
+    
+    def hold_until_done(self, future):
+        """
+        Занять слот до завершения задачи пула, результат которой запрос перестал ждать
+        (по таймауту): процесс пула занят ею, пока она не закончится
+        """
+        with self._condition:
+            self._active += 1
+        future.add_done_callback(self._release_held)
+    
+    def _release_held(self, future):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+    
+    def get_stats(self):
+        """Счётчики допуска и текущая загрузка"""
+        with self._condition:
+            return dict(self.stats, active=self._active, waiting=len(self._latest))
+
+
+class FaceRecognitionPool:
+    """Ограниченный пул процессов распознавания, принадлежащий приложению"""
+    
+    def __init__(self, face_service, service_factory, processes=0, timeout=10.0, worker_init=None,
+                 max_active=0, admission_wait=1.0):
+        """
+        face_service: сервис основного процесса (версии галерей, трекеры камер)
+        service_factory: функция уровня модуля, создающая FaceRecognitionService внутри воркера
+            (передаётся в воркер по имени, её модуль импортируется заранее в forkserver)
+        processes: размер пула (0 - распознавание в потоке запроса)
+        timeout: сколько секунд запрос ждёт результат
+        worker_init: функция, вызываемая в воркере до создания сервиса (например, сброс соединений с БД)
+        max_active: сколько кадров распознаётся одновременно (0 - по числу процессов пула)
+        admission_wait: сколько секунд кадр ждёт свободный слот, прежде чем получить отказ «занят»
+        """
+        self.face_service = face_service
+        self.service_factory = service_factory
+        self.timeout = timeout
+        self.worker_init = worker_init
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # (pid воркера, school_id) -> версия галереи, до которой воркер догнал свою копию
+        self._worker_versions = {}
+        self._worker_versions_lock = threading.Lock()
+        
+        # Воркеры создаются через forkserver, а не fork из потока запроса: при gunicorn --threads
+        # fork скопировал бы в воркер блокировки, занятые другими потоками (пул соединений БД,
+        # logging), и воркер мог бы зависнуть. Без forkserver (Windows) работаем в потоке запроса
+        if processes > 0 and 'forkserver' not in multiprocessing.get_all_start_methods():
+            print("[WARNING] forkserver недоступен, распознавание выполняется в потоке запроса")
+            processes = 0
+        self.processes = processes
+        self.admission = FaceAdmission(max_active or processes or 1, admission_wait)
+    
+    def _get_executor(self):
+        """Создать пул при первом использовании (уже внутри воркера gunicorn)"""
+        with self._executor_lock:
+            if self._executor is None:
+                context = multiprocessing.get_context('forkserver')
+                # Модуль приложения импортируется один раз в forkserver, воркеры получают его готовым
+                context.set_forkserver_preload([self.service_factory.__module__])
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    initargs=(self.service_factory, self.worker_init)
+                )
+            return self._executor
+    
+    def _reset_executor(self):
+        """Пересоздать пул после падения воркера"""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+        with self._worker_versions_lock:
+            self._worker_versions.clear()
+    
+    def recognize(self, data, school_id=None, camera_id=None, tracker=None):
+        """
+        Распознать все лица в байтах изображения
+        tracker: явно переданный FaceTracker (вместо трекера по camera_id)
+        Returns: список словарей как у FaceRecognitionService.recognize_frame
+        Raises: FaceRecognitionTimeout, если результат не получен за timeout секунд;
+            FaceRecognitionBusy / FaceRecognitionSuperseded, если кадр не допущен к распознаванию
+        """
+        # Почти такой же кадр камеры (никого нет, ученик стоит неподвижно) не занимает слот распознавания
+        data_hash, cached_faces = self.face_service.lookup_frame_cache(data, school_id, camera_id)
+        if cached_faces is not None:
+            return cached_faces
+        
+        camera_key = (school_id, camera_id) if camera_id is not None else None
+        started = time.perf_counter()
+        with self.admission.admit(camera_key):
+            self._record_admission(started)
+            faces = self._recognize(data, school_id, camera_id, tracker)
+        self.face_service.store_frame_cache(school_id, camera_id, data_hash, faces)
+        return faces
+    
+    def _recognize(self, data, school_id, camera_id, tracker):
+        """Распознать кадр, уже допущенный к распознаванию"""
+        if self.processes <= 0:
+            return self.face_service.recognize_bytes(data, school_id, camera_id, tracker=tracker, frame_cache=False)
+        
+        gallery = self.face_service.get_gallery(school_id)
+        if len(gallery) == 0:
+            return []
+        
+        service = self.face_service
+        if tracker is None and camera_id is not None and service.tracking_frames > 0:
+            tracker = service.get_tracker(camera_id, school_id)
+        
+        if tracker is None:
+            faces, _ = self._submit(data, school_id, camera_id, gallery, None)
+        else:
+            # Кадры одной камеры обрабатываются последовательно, треки хранятся в основном процессе
+            with tracker.lock:
+                faces, tracks = self._submit(data, school_id, camera_id, gallery, tracker.tracks)
+                tracker.tracks = tracks
+                tracker.last_seen = time.monotonic()
+        
+        # Отказы проверки качества считаются в процессе пула - учесть их в сервисе основного процесса
+        service.record_rejections(service.count_rejections(faces))
+        return faces
+    
+    def recognize_chips(self, chips, school_id=None):
+        """
+        Опознать готовые вырезки лиц (без поиска лиц на сервере)
+        Returns: список словарей как у FaceRecognitionService.recognize_chips
+        Raises: FaceRecognitionTimeout, если результат не получен за timeout секунд;
+            FaceRecognitionBusy, если все слоты распознавания заняты
+        """
+        started = time.perf_counter()
+        with self.admission.admit():
+            self._record_admission(started)
+            if self.processes <= 0:
+                return self.face_service.recognize_chips(chips, school_id)
+            
+            gallery = self.face_service.get_gallery(school_id)
+            if len(gallery) == 0:
+                return [{'student_id': None, 'distance': None} for _ in chips]
+            sync = self._gallery_sync(school_id, gallery)
+            with self.face_service.stage('pool'):
+                results, timings, pid = self._wait(self._get_executor().submit(
+                    _recognize_chips_in_worker, chips, school_id, sync
+                ))
+            self._record_worker_version(pid, school_id, sync[0])
+            self._merge_timings(timings)
+            return results
+    
+    def _gallery_sync(self, school_id, gallery):
+        """
+        Что передать воркеру вместе с задачей, чтобы он догнал свою копию галереи:
+        (версия галереи, since, изменения после since). Изменения берутся начиная
+        с самой старой версии, до которой уже догнали воркеры, поэтому обычно их мало
+        """
+        with self._worker_versions_lock:
+            synced = [version for (_, key), version in self._worker_versions.items() if key == school_id]
+        if not synced:
+            # Ни один воркер ещё не загружал эту галерею - догонять нечего
+            return gallery.version, gallery.version, []
+        since, changes = gallery.changes_since(min(synced))
+        return gallery.version, since, changes
+    
+    def _record_worker_version(self, pid, school_id, version):
+        """Запомнить, до какой версии галереи школы догнал копию воркер pid"""
+        key = (pid, school_id)
+        with self._worker_versions_lock:
+            if self._worker_versions.get(key, 0) < version:
+                self._worker_versions[key] = version
+    
+    def _record_admission(self, started):
+        """Учесть ожидание слота распознавания в замере кадра"""
+        timer = self.face_service.current_timer()
+        if timer is not None:
+            timer.record('admission', (time.perf_counter() - started) * 1000)
+    
+    def _merge_timings(self, timings):
+        """Добавить замеры этапов из процесса пула в замер кадра основного процесса"""
+        timer = self.face_service.current_timer()
+        if timer is not None:
+            timer.merge(timings)
+    
+    def _submit(self, data, school_id, camera_id, gallery, tracks):
+        """
+        Отправить кадр в пул и дождаться результата
+        Returns: (список лиц, обновлённые треки); этап pool - время от отправки до ответа
+        """
+        service = self.face_service
+        sync = self._gallery_sync(school_id, gallery)
+        with service.stage('pool'):
+            faces, tracks, timings, pid = self._wait(self._get_executor().submit(
+                _recognize_in_worker, data, school_id, camera_id, sync, tracks,
+                service.tracking_iou, service.tracking_frames
+            ))
+        self._record_worker_version(pid, school_id, sync[0])
+        self._merge_timings(timings)
+        return faces, tracks
+    
+    def _wait(self, future):
+        """Дождаться результата задачи пула"""
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            if not future.cancel():
+                # Задача уже выполняется - слот допуска освободится, когда она закончится
+                self.admission.hold_until_done(future)
+            raise FaceRecognitionTimeout(f"Распознавание не завершилось за {self.timeout} с")
+        except BrokenProcessPool:
+            self._reset_executor()
+            raise
+    
+    def shutdown(self):
+        """Остановить процессы пула"""
+        self._reset_executor()
+
+
+class FaceRecognitionStream:
+    """
+    Состояние одного потокового соединения киоска (WebSocket страницы камеры):
+    галерея школы, собственный трекер лиц и последние результаты.
+    Кадры соединения обрабатываются строго по очереди
+    """
+    
+    def __init__(self, pool, school_id=None, camera_id=None, repeat_seconds=5.0):
+        """
+        pool: FaceRecognitionPool приложения
+        repeat_seconds: ученик, пропавший из кадра дольше этого времени, сообщается снова
+        """
+        self.pool = pool
+        self.school_id = school_id
+        self.camera_id = camera_id
+        self.repeat_seconds = repeat_seconds
+        
+        service = pool.face_service
+        self.gallery = service.get_gallery(school_id)
+        self.tracker = None
+        if service.tracking_frames > 0:
+            self.tracker = FaceTracker(service.tracking_iou, service.tracking_frames)
+        
+        self.frames = 0
+        self.last_faces = []
+        # student_id -> время (monotonic), когда ученик последний раз был в кадре
+        self.last_seen = {}
+    
+    def process(self, data):
+        """
+        Распознать очередной кадр соединения
+        Returns: (список лиц как у recognize_frame, student_id впервые появившихся в кадре учеников)
+        Raises: FaceRecognitionTimeout, FaceRecognitionBusy - как у FaceRecognitionPool.recognize
+        """
+        self.frames += 1
+        # Галерея могла быть перезагружена (изменения учеников, вытеснение из кэша)
+        self.gallery = self.pool.face_service.get_gallery(self.school_id)
+        if len(self.gallery) == 0:
+            self.last_faces = []
+            return [], []
+        
+        faces = self.pool.recognize(data, self.school_id, self.camera_id, tracker=self.tracker)
+        self.last_faces = faces
+        
+        now = time.monotonic()
+        appeared = []
+        for face in faces:
+            student_id = face['student_id']
+            if student_id is None:
+                continue
+            last_seen = self.last_seen.get(student_id)
+            if (last_seen is None or now - last_seen > self.repeat_seconds) and student_id not in appeared:
+                appeared.append(student_id)
+            self.last_seen[student_id] = now
+        
+        # Не копить учеников, давно ушедших из кадра
+        for student_id in [sid for sid, seen in self.last_seen.items() if now - seen > self.repeat_seconds]:
+            del self.last_seen[student_id]
+        return faces, appeared
@@ -0,0 +1,144 @@
+"""
+Сравнение детекторов лиц (hog, cnn, dnn, haar) на локальном наборе изображений.
+
+Для каждого детектора: кадров в секунду, задержка p50/p95 и полнота (recall).
+Разметка - необязательный JSON {"имя_файла": [[top, right, bottom, left], ...]};
+без неё считается, что на каждом изображении есть хотя бы одно лицо, и recall -
+доля изображений, на которых найдено хоть одно лицо.
+
+Использование:
+    python face_detector_benchmark.py --images photos/entrance
+    python face_detector_benchmark.py --images photos/entrance --annotations boxes.json --scale 0.5
+    python face_detector_benchmark.py --images photos/entrance --detectors hog,haar --json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from backend.services.face_service import DETECTORS, FaceRecognitionService, box_iou
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def load_images(directory, limit=None):
+    """RGB изображения каталога: список (имя файла, кадр)"""
+    images = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        frame = cv2.imread(os.path.join(directory, filename), cv2.IMREAD_COLOR)
+        if frame is None:
+            print(f"[WARNING] Не удалось прочитать {filename}", file=sys.stderr)
+            continue
+        images.append((filename, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+        if limit and len(images) >= limit:
+            break
+    return images
+
+
+def count_found(locations, expected, iou_threshold):
+    """Сколько размеченных лиц покрыто найденными рамками (каждая рамка засчитывается один раз)"""
+    unused = list(locations)
+    found = 0
+    for box in expected:
+        best = max(unused, key=lambda location: box_iou(location, box), default=None)
+        if best is not None and box_iou(best, box) >= iou_threshold:
+            unused.remove(best)
+            found += 1
+    return found
+
+
+def benchmark_detector(name, images, annotations, scale, upsample, repeat, iou_threshold):
+    """Замер одного детектора на всех изображениях"""
+    service = FaceRecognitionService(detector=name, detection_scale=scale, upsample=upsample)
+    detector = service.get_detector(name)
+    if detector.name != name:
+        return {'detector': name, 'error': 'недоступен'}
+
+    latencies = []
+    expected_faces = 0
+    found_faces = 0
+    detections = 0
+    for filename, rgb_frame in images:
+        # Первый прогон не замеряется: загрузка модели и прогрев кэшей
+        locations = service.detect_faces(rgb_frame)
+        for _ in range(repeat):
+            started = time.perf_counter()
+            locations = service.detect_faces(rgb_frame)
+            latencies.append(time.perf_counter() - started)
+        detections += len(locations)
+
+        if annotations is not None:
+            expected = [tuple(box) for box in annotations.get(filename, [])]
+            expected_faces += len(expected)
+            found_faces += count_found(locations, expected, iou_threshold)
+        else:
+            expected_faces += 1
+            found_faces += 1 if locations else 0
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'detector': name,
+        'images': len(images),
+        'fps': len(latencies) / float(np.sum(latencies)) if latencies else 0.0,
+        'p50_ms': float(np.percentile(latencies_ms, 50)) if latencies else None,
+        'p95_ms': float(np.percentile(latencies_ms, 95)) if latencies else None,
+        'recall': found_faces / expected_faces if expected_faces else None,
+        'detections': detections,
+    }
+
+
+def print_report(results, scale, upsample):
+    """Текстовый вывод результатов"""
+    print(f"scale: {scale}, upsample: {upsample}")
+    print(f"{'детектор':<8} {'FPS':>8} {'p50, мс':>9} {'p95, мс':>9} {'recall':>8} {'рамок':>7}")
+    for row in results:
+        if 'error' in row:
+            print(f"{row['detector']:<8} {row['error']}")
+            continue
+        print(f"{row['detector']:<8} {row['fps']:>8.1f} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['recall']:>8.1%} {row['detections']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение детекторов лиц')
+    parser.add_argument('--images', required=True, help='Каталог с изображениями')
+    parser.add_argument('--annotations', help='JSON разметка лиц {файл: [[top, right, bottom, left], ...]}')
+    parser.add_argument('--detectors', default=','.join(DETECTORS), help='Список детекторов через запятую')
+    parser.add_argument('--scale', type=float, default=1.0, help='detection_scale')
+    parser.add_argument('--upsample', type=int, default=1, help='upsample для hog/cnn')
+    parser.add_argument('--repeat', type=int, default=3, help='Сколько раз замерять каждое изображение')
+    parser.add_argument('--limit', type=int, help='Не больше N изображений')
+    parser.add_argument('--iou', type=float, default=0.3, help='Минимальный IoU найденной рамки с разметкой')
+    parser.add_argument('--json', action='store_true', help='Вывести результаты в JSON')
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.limit)
+    if not images:
+        parser.error(f"В каталоге {args.images} нет изображений")
+
+    annotations = None
+    if args.annotations:
+        with open(args.annotations, 'r', encoding='utf-8') as f:
+            annotations = json.load(f)
+
+    results = [
+        benchmark_detector(name.strip(), images, annotations, args.scale, args.upsample, args.repeat, args.iou)
+        for name in args.detectors.split(',') if name.strip()
+    ]
+    if args.json:
+        print(json.dumps({'scale': args.scale, 'upsample': args.upsample, 'results': results},
+                         ensure_ascii=False, indent=2))
+    else:
+        print_report(results, args.scale, args.upsample)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Отчёт о точности компактных форматов галереи (float16 / int8).
+
+Сравнивает решения match (ученик или «не опознан») галереи в формате float16/int8
+с эталоном float64 при пороге tolerance. По умолчанию использует синтетическую
+галерею, похожую на encodings dlib; реальные encodings можно передать файлом .npy.
+Второй случай - новая школа: галерея загружается из --initial учеников, остальные
+добавляются по одному через upsert (масштаб int8 подобран только под первых).
+
+Использование:
+    python face_quantization_report.py
+    python face_quantization_report.py --gallery encodings.npy --queries queries.npy
+    python face_quantization_report.py --json
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from backend.services.face_service import FaceGallery
+
+ENCODING_DIM = FaceGallery.ENCODING_DIM
+
+
+def make_synthetic_gallery(size, seed=0, identity_spread=0.056):
+    """
+    Синтетические encodings, похожие на dlib: центры учеников разнесены на ~0.9,
+    повторные снимки одного ученика - на 0.2-0.6
+    Returns: (центры учеников (size, 128), генератор случайных чисел)
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0.0, identity_spread, size=(size, ENCODING_DIM))
+    # Среднее значение по измерениям у dlib не нулевое
+    centers += rng.normal(0.0, 0.05, size=ENCODING_DIM)
+    return centers, rng
+
+
+def make_synthetic_queries(centers, rng, count, impostor_share=0.3, sample_noise=(0.02, 0.056)):
+    """
+    Запросы: повторные снимки случайных учеников галереи и посторонние лица
+    Returns: матрица запросов (count, 128)
+    """
+    impostors = int(count * impostor_share)
+    known = count - impostors
+    rows = rng.integers(0, len(centers), size=known)
+    noise = rng.uniform(*sample_noise, size=(known, 1))
+    queries = centers[rows] + rng.normal(0.0, 1.0, size=(known, ENCODING_DIM)) * noise
+    strangers = rng.normal(0.0, centers.std(), size=(impostors, ENCODING_DIM)) + centers.mean(axis=0)
+    return np.vstack([queries, strangers])
+
+
+def baseline_match(gallery, queries, tolerance):
+    """Эталон: полный перебор во float64"""
+    distances = np.vstack([np.linalg.norm(gallery - query, axis=1) for query in queries])
+    best = np.argmin(distances, axis=1)
+    best_distances = distances[np.arange(len(queries)), best]
+    return [
+        (int(row) if distance <= tolerance else None, float(distance))
+        for row, distance in zip(best, best_distances)
+    ]
+
+
+def compare_storage(gallery, queries, storage, tolerance, baseline, initial=None):
+    """
+    Решения галереи в формате storage против эталона
+    initial: загрузить только первых initial учеников, остальных добавить через upsert
+    """
+    face_gallery = FaceGallery(storage=storage)
+    if initial is None:
+        face_gallery.load(gallery, list(range(len(gallery))))
+    else:
+        face_gallery.load(gallery[:initial], list(range(initial)))
+        for row in range(initial, len(gallery)):
+            face_gallery.upsert(row, gallery[row])
+    results = face_gallery.match(queries.astype(np.float32), tolerance)
+
+    disagreements = 0
+    false_accepts = 0
+    false_rejects = 0
+    wrong_student = 0
+    max_distance_error = 0.0
+    for (expected, expected_distance), (student_id, distance) in zip(baseline, results):
+        max_distance_error = max(max_distance_error, abs(distance - expected_distance))
+        if student_id == expected:
+            continue
+        disagreements += 1
+        if expected is None:
+            false_accepts += 1
+        elif student_id is None:
+            false_rejects += 1
+        else:
+            wrong_student += 1
+
+    return {
+        'storage': storage,
+        'bytes_per_student': face_gallery.nbytes // max(len(face_gallery), 1),
+        'gallery_bytes': int(face_gallery.nbytes),
+        'disagreements': disagreements,
+        'agreement': 1.0 - disagreements / max(len(queries), 1),
+        'false_accepts': false_accepts,
+        'false_rejects': false_rejects,
+        'wrong_student': wrong_student,
+        'max_distance_error': max_distance_error,
+    }
+
+
+def build_report(gallery, queries, tolerance=0.6, storages=('float32', 'float16', 'int8'), initial=20):
+    """Отчёт по всем форматам хранения"""
+    gallery = np.asarray(gallery, dtype=np.float64)
+    queries = np.asarray(queries, dtype=np.float64)
+    baseline = baseline_match(gallery, queries, tolerance)
+
+    # Запросы, у которых эталонное расстояние близко к порогу, - самые чувствительные к квантованию
+    near_threshold = sum(1 for _, distance in baseline if abs(distance - tolerance) < 0.01)
+    return {
+        'gallery_size': len(gallery),
+        'queries': len(queries),
+        'tolerance': tolerance,
+        'baseline_matched': sum(1 for student_id, _ in baseline if student_id is not None),
+        'near_threshold_queries': near_threshold,
+        'storages': [compare_storage(gallery, queries, storage, tolerance, baseline) for storage in storages],
+        'upsert_initial': initial,
+        'upserts': [
+            compare_storage(gallery, queries, storage, tolerance, baseline, initial=min(initial, len(gallery)))
+            for storage in storages
+        ],
+    }
+
+
+def print_report(report):
+    """Текстовый вывод отчёта"""
+    print(f"Галерея: {report['gallery_size']}, запросов: {report['queries']}, "
+          f"tolerance: {report['tolerance']}")
+    print(f"Опознано эталоном float64: {report['baseline_matched']}, "
+          f"рядом с порогом (±0.01): {report['near_threshold_queries']}")
+    print_table(report['storages'])
+    print()
+    print(f"Загружено {report['upsert_initial']} учеников, остальные добавлены через upsert:")
+    print_table(report['upserts'])
+
+
+def print_table(rows):
+    """Таблица сравнения форматов хранения"""
+    print()
+    print(f"{'формат':<8} {'байт/уч.':>9} {'совпадение':>11} {'ложн. +':>8} {'ложн. -':>8} "
+          f"{'др. уч.':>8} {'макс. ошибка':>13}")
+    for row in rows:
+        print(f"{row['storage']:<8} {row['bytes_per_student']:>9} {row['agreement']:>11.4%} "
+              f"{row['false_accepts']:>8} {row['false_rejects']:>8} {row['wrong_student']:>8} "
+              f"{row['max_distance_error']:>13.5f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Точность float16/int8 галереи против float64')
+    parser.add_argument('--gallery', help='.npy с encodings галереи (N, 128)')
+    parser.add_argument('--queries', help='.npy с encodings запросов (M, 128)')
+    parser.add_argument('--size', type=int, default=5000, help='Размер синтетической галереи')
+    parser.add_argument('--count', type=int, default=2000, help='Число синтетических запросов')
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--initial', type=int, default=20,
+                        help='Сколько учеников загрузить до upsert остальных (новая школа)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Вывести отчёт в JSON')
+    args = parser.parse_args()
+
+    if args.gallery:
+        gallery = np.load(args.gallery)
+        if args.queries:
+            queries = np.load(args.queries)
+        else:
+            # Без запросов - зашумлённые копии самой галереи
+            rng = np.random.default_rng(args.seed)
+            rows = rng.integers(0, len(gallery), size=args.count)
+            queries = gallery[rows] + rng.normal(0.0, 0.03, size=(args.count, ENCODING_DIM))
+    else:
+        gallery, rng = make_synthetic_gallery(args.size, args.seed)
+        queries = make_synthetic_queries(gallery, rng, args.count)
+
+    report = build_report(gallery, queries, args.tolerance, initial=args.initial)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+"""
+Бенчмарк сопоставления FaceRecognitionService на синтетических галереях.
+
+Галереи от 100 до 100k учеников с encodings, похожими на dlib: ученики сгруппированы в
+кластеры (похожие лица одного возраста и внешности), часть учеников - почти дубликаты
+(братья, сёстры, близнецы) на расстоянии около порога. «Кадры» - фиксированный по seed
+набор запросов: по одному и по нескольку лиц в кадре, знакомые ученики, почти дубликаты
+и посторонние.
+
+Для каждого размера галереи и формата хранения: время загрузки (с построением индекса),
+память, время подключения снимка с диска, задержка p50/p95/p99 на кадр и пропускная
+способность для кадров с одним и несколькими лицами, совпадение решений с точным
+перебором float64. С --images дополнительно прогоняется полный конвейер
+(декодирование, поиск лиц, encoding) на реальных кадрах с замерами этапов.
+
+Отчёт - JSON (--json или --output); --baseline сравнивает с прошлым отчётом и завершается
+с кодом 1, если задержка выросла больше --max-slowdown раз или упало совпадение решений.
+
+Использование:
+    python face_service_benchmark.py
+    python face_service_benchmark.py --sizes 100,1000,10000 --storages float32,int8 --output bench.json
+    python face_service_benchmark.py --baseline bench.json --max-slowdown 1.25
+    python face_service_benchmark.py --images photos/entrance --sizes 10000 --json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from backend.services.face_service import FaceGallery, FaceRecognitionService, GallerySnapshotStore, TimingStats
+
+ENCODING_DIM = FaceGallery.ENCODING_DIM
+SCHOOL_ID = 1
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Виды кадров: имя -> лиц в кадре
+FRAME_KINDS = {'single': 1, 'multi': 5}
+
+
+def make_gallery(size, rng, cluster_spread=0.035, identity_spread=0.045,
+                 near_duplicate_share=0.02, near_duplicate_distance=0.45):
+    """
+    Синтетическая галерея: центры кластеров вокруг общего среднего (у dlib оно не нулевое),
+    ученики - вокруг центров. Разные ученики одного кластера - на расстоянии ~0.7,
+    разных кластеров - ~0.9, почти дубликаты - на near_duplicate_distance от «оригинала»
+    Returns: (матрица (size, 128) float32, номера строк почти дубликатов)
+    """
+    clusters = max(1, int(np.sqrt(size) / 2))
+    centers = rng.normal(0.0, 0.05, size=ENCODING_DIM) + rng.normal(0.0, cluster_spread, size=(clusters, ENCODING_DIM))
+    gallery = centers[rng.integers(0, clusters, size=size)] + rng.normal(0.0, identity_spread, size=(size, ENCODING_DIM))
+
+    duplicates = int(size * near_duplicate_share)
+    duplicate_rows = np.empty(0, dtype=np.int64)
+    if duplicates:
+        rows = rng.choice(size, size=duplicates * 2, replace=False)
+        originals, duplicate_rows = rows[:duplicates], rows[duplicates:]
+        direction = rng.normal(size=(duplicates, ENCODING_DIM))
+        direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+        gallery[duplicate_rows] = gallery[originals] + direction * near_duplicate_distance
+    return gallery.astype(np.float32), duplicate_rows
+
+
+def make_frames(gallery, duplicate_rows, rng, count, faces_per_frame,
+                impostor_share=0.2, near_duplicate_share=0.1, sample_distance=(0.15, 0.45)):
+    """
+    Фиксированный набор кадров: повторные снимки учеников галереи (на расстоянии
+    sample_distance от encoding галереи), снимки почти дубликатов и посторонние лица
+    Returns: список матриц (faces_per_frame, 128) float32
+    """
+    total = count * faces_per_frame
+    impostors = int(total * impostor_share)
+    near = int(total * near_duplicate_share) if len(duplicate_rows) else 0
+    known = total - impostors - near
+
+    rows = np.concatenate([
+        rng.integers(0, len(gallery), size=known),
+        rng.choice(duplicate_rows, size=near) if near else np.empty(0, dtype=np.int64),
+    ])
+    direction = rng.normal(size=(len(rows), ENCODING_DIM))
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    queries = gallery[rows] + direction * rng.uniform(*sample_distance, size=(len(rows), 1))
+
+    spread = gallery.std(axis=0)
+    strangers = gallery.mean(axis=0) + rng.normal(0.0, 1.0, size=(impostors, ENCODING_DIM)) * spread
+
+    queries = np.vstack([queries, strangers]).astype(np.float32)
+    queries = queries[rng.permutation(len(queries))]
+    return [queries[start:start + faces_per_frame] for start in range(0, total, faces_per_frame)]
+
+
+def exact_match(gallery, queries, tolerance, batch_size=64):
+    """Эталон: полный перебор во float64. Returns: массив номеров строк (-1 - не опознан)"""
+    gallery64 = gallery.astype(np.float64)
+    gallery_norms = np.einsum('ij,ij->i', gallery64, gallery64)
+    expected = np.empty(len(queries), dtype=np.int64)
+    for start in range(0, len(queries), batch_size):
+        chunk = queries[start:start + batch_size].astype(np.float64)
+        squared = np.einsum('ij,ij->i', chunk, chunk)[:, None] + gallery_norms[None, :] - 2.0 * (chunk @ gallery64.T)
+        best = np.argmin(squared, axis=1)
+        distances = np.sqrt(np.maximum(squared[np.arange(len(chunk)), best], 0.0))
+        expected[start:start + batch_size] = np.where(distances <= tolerance, best, -1)
+    return expected
+
+
+def percentiles_ms(latencies):
+    """p50/p95/p99 задержек в миллисекундах"""
+    values = np.asarray(latencies) * 1000
+    return {f'p{p}': round(float(np.percentile(values, p)), 4) for p in (50, 95, 99)}
+
+
+def create_service(storage, tolerance, index_threshold):
+    """Сервис без БД и детектора: только галерея и сопоставление"""
+    return FaceRecognitionService(tolerance=tolerance, storage=storage, index_threshold=index_threshold)
+
+
+def load_gallery(service, gallery, student_ids):
+    """Загрузка галереи (служебный вывод сервиса уходит в stderr, stdout занят отчётом)"""
+    with contextlib.redirect_stdout(sys.stderr):
+        return service.load_encodings(student_ids, gallery, SCHOOL_ID)
+
+
+def measure_load(gallery, student_ids, storage, tolerance, index_threshold):
+    """Время загрузки и память: отдельный прогон под tracemalloc, чтобы не искажать время"""
+    service = create_service(storage, tolerance, index_threshold)
+    started = time.perf_counter()
+    face_gallery = load_gallery(service, gallery, student_ids)
+    load_seconds = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        load_gallery(create_service(storage, tolerance, index_threshold), gallery, student_ids)
+        allocated, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return service, face_gallery, {
+        'load_ms': round(load_seconds * 1000, 3),
+        'gallery_bytes': int(face_gallery.nbytes),
+        'bytes_per_student': int(face_gallery.nbytes // max(len(face_gallery), 1)),
+        'allocated_bytes': int(allocated),
+        'peak_bytes': int(peak),
+        'indexed': face_gallery.uses_index,
+    }
+
+
+def measure_snapshot(face_gallery, index_threshold):
+    """Сохранение снимка галереи и подключение его с диска (mmap), как при старте воркера"""
+    with tempfile.TemporaryDirectory() as directory:
+        store = GallerySnapshotStore(directory)
+        started = time.perf_counter()
+        store.save(SCHOOL_ID, face_gallery, face_gallery.version)
+        save_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        snapshot = store.load(SCHOOL_ID)
+        attached = FaceGallery(index_threshold, storage=snapshot['storage'], scale=snapshot['scale'])
+        attached.attach(snapshot['matrix'], snapshot['norms'], snapshot['student_ids'], snapshot['samples'],
+                        snapshot['index'])
+        attach_seconds = time.perf_counter() - started
+        del attached, snapshot
+    return {'snapshot_save_ms': round(save_seconds * 1000, 3), 'snapshot_attach_ms': round(attach_seconds * 1000, 3)}
+
+
+def measure_matching(service, frames, expected, student_ids, duplicate_ids):
+    """Задержка и пропускная способность сопоставления кадров, совпадение решений с эталоном"""
+    # Первый кадр не замеряется: ленивое построение индекса и прогрев кэшей
+    started = time.perf_counter()
+    service.match_encodings(frames[0], SCHOOL_ID)
+    first_seconds = time.perf_counter() - started
+
+    latencies = []
+    results = []
+    for frame in frames:
+        started = time.perf_counter()
+        matches = service.match_encodings(frame, SCHOOL_ID)
+        latencies.append(time.perf_counter() - started)
+        results.extend(student_id for student_id, _ in matches)
+
+    expected_ids = [student_ids[row] if row >= 0 else None for row in expected]
+    disagreements = [(got, want) for got, want in zip(results, expected_ids) if got != want]
+    near = [(got, want) for got, want in zip(results, expected_ids) if want in duplicate_ids]
+    total_seconds = float(np.sum(latencies))
+    faces = sum(len(frame) for frame in frames)
+    return {
+        'frames': len(frames),
+        'faces': faces,
+        'first_frame_ms': round(first_seconds * 1000, 3),
+        'latency_ms': percentiles_ms(latencies),
+        'frames_per_second': round(len(frames) / total_seconds, 1) if total_seconds else None,
+        'faces_per_second': round(faces / total_seconds, 1) if total_seconds else None,
+        'agreement': round(1.0 - len(disagreements) / max(faces, 1), 6),
+        'false_accepts': sum(1 for got, want in disagreements if want is None),
+        'false_rejects': sum(1 for got, want in disagreements if got is None),
+        'wrong_student': sum(1 for got, want in disagreements if got is not None and want is not None),
+        'near_duplicate_agreement': round(sum(1 for got, want in near if got == want) / len(near), 6) if near else None,
+    }
+
+
+def load_images(directory, limit=None):
+    """Байты изображений каталога: список (имя файла, bytes)"""
+    images = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(directory, filename), 'rb') as f:
+            images.append((filename, f.read()))
+        if limit and len(images) >= limit:
+            break
+    return images
+
+
+def measure_pipeline(service, images, repeat):
+    """Полный конвейер на реальных кадрах: задержка кадра и перцентили этапов (StageTimer)"""
+    service.recognize_bytes(images[0][1], SCHOOL_ID, frame_cache=False)
+    latencies = []
+    samples = []
+    for _ in range(repeat):
+        for _, data in images:
+            started = time.perf_counter()
+            with service.timing() as timer:
+                service.recognize_bytes(data, SCHOOL_ID, frame_cache=False)
+            latencies.append(time.perf_counter() - started)
+            samples.append(timer.as_dict())
+    summary = TimingStats.summarize(samples)
+    return {
+        'frames': len(latencies),
+        'latency_ms': percentiles_ms(latencies),
+        'frames_per_second': round(len(latencies) / float(np.sum(latencies)), 2),
+        'stages': summary['stages'],
+        'counts': summary['counts'],
+    }
+
+
+def run_benchmark(args):
+    """Все замеры: для каждого размера галереи и формата хранения"""
+    storages = [storage.strip() for storage in args.storages.split(',') if storage.strip()]
+    images = load_images(args.images, args.limit) if args.images else []
+    results = []
+    for size in [int(size) for size in args.sizes.split(',') if size.strip()]:
+        # Галерея и кадры зависят только от seed и размера - одинаковы во всех прогонах
+        rng = np.random.default_rng([args.seed, size])
+        gallery, duplicate_rows = make_gallery(size, rng)
+        student_ids = list(range(1, size + 1))
+        duplicate_ids = {student_ids[row] for row in duplicate_rows}
+        frames = {
+            kind: make_frames(gallery, duplicate_rows, rng, args.frames, faces_per_frame)
+            for kind, faces_per_frame in FRAME_KINDS.items()
+        }
+        expected = {
+            kind: exact_match(gallery, np.vstack(kind_frames), args.tolerance)
+            for kind, kind_frames in frames.items()
+        }
+
+        for storage in storages:
+            print(f"[benchmark] галерея {size}, {storage}", file=sys.stderr)
+            service, face_gallery, row = measure_load(gallery, student_ids, storage, args.tolerance, args.index_threshold)
+            row = dict({'size': size, 'storage': storage}, **row)
+            row.update(measure_snapshot(face_gallery, args.index_threshold))
+            row['matching'] = {
+                kind: measure_matching(service, kind_frames, expected[kind], student_ids, duplicate_ids)
+                for kind, kind_frames in frames.items()
+            }
+            if images:
+                row['pipeline'] = measure_pipeline(service, images, args.repeat)
+            results.append(row)
+
+    return {
+        'benchmark': 'face_service',
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+        },
+        'parameters': {
+            'seed': args.seed,
+            'tolerance': args.tolerance,
+            'index_threshold': args.index_threshold,
+            'frames': args.frames,
+            'faces_per_frame': FRAME_KINDS,
+            'images': len(images),
+        },
+        'results': results,
+    }
+
+
+def is_slower(new_ms, old_ms, max_slowdown, min_delta_ms):
+    """Замедление больше допустимого (доли миллисекунды не считаются - это шум измерения)"""
+    return new_ms > old_ms * max_slowdown and new_ms - old_ms > min_delta_ms
+
+
+def find_regressions(report, baseline, max_slowdown, max_agreement_drop, min_delta_ms=0.5):
+    """Сравнение с прошлым отчётом. Returns: список описаний регрессий"""
+    previous = {(row['size'], row['storage']): row for row in baseline.get('results', [])}
+    regressions = []
+    for row in report['results']:
+        old = previous.get((row['size'], row['storage']))
+        if old is None:
+            continue
+        name = f"{row['size']}/{row['storage']}"
+        if is_slower(row['load_ms'], old['load_ms'], max_slowdown, min_delta_ms):
+            regressions.append(f"{name}: загрузка {old['load_ms']:.1f} -> {row['load_ms']:.1f} мс")
+        if row['gallery_bytes'] > old['gallery_bytes']:
+            regressions.append(f"{name}: память галереи {old['gallery_bytes']} -> {row['gallery_bytes']} байт")
+        for kind, matching in row['matching'].items():
+            old_matching = old.get('matching', {}).get(kind)
+            if old_matching is None:
+                continue
+            if is_slower(matching['latency_ms']['p95'], old_matching['latency_ms']['p95'], max_slowdown, min_delta_ms):
+                regressions.append(f"{name} {kind}: p95 {old_matching['latency_ms']['p95']:.3f} -> "
+                                   f"{matching['latency_ms']['p95']:.3f} мс")
+            if matching['agreement'] < old_matching['agreement'] - max_agreement_drop:
+                regressions.append(f"{name} {kind}: совпадение с эталоном {old_matching['agreement']:.4%} -> "
+                                   f"{matching['agreement']:.4%}")
+    return regressions
+
+
+def print_report(report):
+    """Текстовый вывод результатов"""
+    print(f"tolerance: {report['parameters']['tolerance']}, "
+          f"index_threshold: {report['parameters']['index_threshold']}, "
+          f"кадров каждого вида: {report['parameters']['frames']}")
+    print(f"{'размер':>7} {'формат':<8} {'индекс':>6} {'загрузка, мс':>13} {'память, КБ':>11} {'снимок, мс':>11} "
+          f"{'кадр':<6} {'p50, мс':>8} {'p95, мс':>8} {'p99, мс':>8} {'лиц/с':>9} {'совпадение':>11}")
+    for row in report['results']:
+        for kind, matching in row['matching'].items():
+            print(f"{row['size']:>7} {row['storage']:<8} {'да' if row['indexed'] else 'нет':>6} "
+                  f"{row['load_ms']:>13.1f} {row['gallery_bytes'] / 1024:>11.0f} {row['snapshot_attach_ms']:>11.2f} "
+                  f"{kind:<6} {matching['latency_ms']['p50']:>8.3f} {matching['latency_ms']['p95']:>8.3f} "
+                  f"{matching['latency_ms']['p99']:>8.3f} {matching['faces_per_second']:>9.0f} "
+                  f"{matching['agreement']:>11.4%}")
+        if 'pipeline' in row:
+            pipeline = row['pipeline']
+            stages = ', '.join(f"{name} {values['p50']:.1f}" for name, values in pipeline['stages'].items())
+            print(f"{'':>7} полный конвейер: p50 {pipeline['latency_ms']['p50']:.1f} мс, "
+                  f"{pipeline['frames_per_second']:.1f} кадров/с; этапы p50, мс: {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк сопоставления лиц на синтетических галереях')
+    parser.add_argument('--sizes', default='100,1000,10000,100000', help='Размеры галерей через запятую')
+    parser.add_argument('--storages', default='float32,float16,int8', help='Форматы хранения через запятую')
+    parser.add_argument('--frames', type=int, default=200, help='Кадров каждого вида (1 лицо и 5 лиц)')
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--index-threshold', type=int, default=20000,
+                        help='С какого размера галереи использовать индекс (как FACE_INDEX_THRESHOLD)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--images', help='Каталог с кадрами камеры для замера полного конвейера')
+    parser.add_argument('--limit', type=int, help='Не больше N изображений')
+    parser.add_argument('--repeat', type=int, default=3, help='Сколько раз прогонять кадры из --images')
+    parser.add_argument('--json', action='store_true', help='Вывести отчёт в JSON')
+    parser.add_argument('--output', help='Записать JSON отчёт в файл')
+    parser.add_argument('--baseline', help='JSON отчёт прошлого прогона для поиска регрессий')
+    parser.add_argument('--max-slowdown', type=float, default=1.25,
+                        help='Во сколько раз может вырасти время загрузки и p95 кадра')
+    parser.add_argument('--min-delta-ms', type=float, default=0.5,
+                        help='Замедление меньше стольких миллисекунд не считается регрессией')
+    parser.add_argument('--max-agreement-drop', type=float, default=0.001,
+                        help='На сколько может упасть доля совпадений с эталоном')
+    args = parser.parse_args()
+
+    if args.images and not load_images(args.images, 1):
+        parser.error(f"В каталоге {args.images} нет изображений")
+
+    report = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = find_regressions(report, baseline, args.max_slowdown, args.max_agreement_drop, args.min_delta_ms)
+        for regression in regressions:
+            print(f"[REGRESSION] {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,13 @@ let stream = null;
 let recognitionInterval = null;
 let isProcessing = false;
 
+// Постоянный идентификатор камеры (киоска) для трекинга лиц на сервере
+let cameraId = localStorage.getItem('cameraId');
+if (!cameraId) {
+    cameraId = 'cam-' + Math.random().toString(36).slice(2, 10);
+    localStorage.setItem('cameraId', cameraId);
+}
+
 // Запуск камеры
 startBtn.addEventListener('click', async () => {
     try {
@@ -20,8 +27,8 @@ startBtn.addEventListener('click', async () => {
         // Добавить визуальный эффект сканирования
         video.classList.add('scanning');
         
-        // Запустить автоматическое распознавание каждые 2 секунды
-        recognitionInterval = setInterval(autoRecognize, 2000);
+        // Потоковое распознавание по WebSocket; без него - запрос каждые 2 секунды
+        openRecognitionStream();
         
         document.getElementById('recognitionResult').innerHTML = 
             '<p class="info-text">🔍 Автоматическое сканирование активно...</p>';
@@ -30,6 +37,160 @@ startBtn.addEventListener('click', async () => {
     }
 });
 
+// Детектор лиц браузера (Shape Detection API), если доступен: на сервер уходят только вырезки лиц
+const faceDetector = 'FaceDetector' in window ? new FaceDetector({ fastMode: true, maxDetectedFaces: 8 }) : null;
+const CHIP_SIZE = 150;
+// Сторона вырезки относительно рамки лица; сервер убирает этот запас (FaceRecognitionService.CHIP_MARGIN)
+const CHIP_MARGIN = 1.3;
+const chipCanvas = document.createElement('canvas');
+chipCanvas.width = CHIP_SIZE;
+chipCanvas.height = CHIP_SIZE;
+const chipCtx = chipCanvas.getContext('2d');
+
+function canvasToBlob(target) {
+    return new Promise((resolve) => target.toBlob(resolve, 'image/jpeg', 0.9));
+}
+
+// Вырезать лица с запасом по краям и привести к CHIP_SIZE x CHIP_SIZE
+async function detectFaceChips() {
+    const faces = await faceDetector.detect(canvas);
+    const chips = [];
+    for (const face of faces) {
+        const box = face.boundingBox;
+        const size = Math.max(box.width, box.height) * CHIP_MARGIN;
+        const left = box.x + box.width / 2 - size / 2;
+        const top = box.y + box.height / 2 - size / 2;
+        const scale = CHIP_SIZE / size;
+        // У края кадра вырезка не сдвигается, а дополняется чёрным: лицо остаётся в центре,
+        // как ожидает сервер
+        const x = Math.max(0, left);
+        const y = Math.max(0, top);
+        const width = Math.min(canvas.width, left + size) - x;
+        const height = Math.min(canvas.height, top + size) - y;
+        chipCtx.fillStyle = '#000';
+        chipCtx.fillRect(0, 0, CHIP_SIZE, CHIP_SIZE);
+        if (width > 0 && height > 0) {
+            chipCtx.drawImage(canvas, x, y, width, height,
+                (x - left) * scale, (y - top) * scale, width * scale, height * scale);
+        }
+        chips.push(await canvasToBlob(chipCanvas));
+    }
+    return chips;
+}
+
+// Запрос распознавания с отметкой прихода: вырезки лиц или целый кадр. null - отправлять нечего
+async function buildRecognitionRequest() {
+    const formData = new FormData();
+    formData.append('camera_id', cameraId);
+    
+    if (faceDetector) {
+        try {
+            const chips = await detectFaceChips();
+            if (chips.length === 0) return null;
+            chips.forEach((chip, index) => formData.append('chips', chip, `face_${index}.jpg`));
+            return { url: '/api/recognize_checkin', body: formData };
+        } catch (error) {
+            console.warn('Детектор лиц браузера недоступен, отправляется целый кадр:', error);
+        }
+    }
+    
+    formData.append('image', await canvasToBlob(canvas), 'capture.jpg');
+    return { url: '/api/recognize_checkin', body: formData };
+}
+
+// Захватить кадр с камеры в canvas
+function captureFrame() {
+    canvas.width = video.videoWidth;
+    canvas.height = video.videoHeight;
+    ctx.drawImage(video, 0, 0);
+}
+
+// ===== ПОТОКОВОЕ РАСПОЗНАВАНИЕ (WebSocket) =====
+// Одно соединение на киоск: кадр уходит после ответа на предыдущий, сервер держит трекер
+// и сразу отмечает приход учеников, впервые появившихся в кадре
+// Пауза между кадрами, пока сервер не прислал свою в событии hello
+const STREAM_FRAME_DELAY_MS = 2000;
+const STREAM_BUSY_DELAY_MS = 1000;
+const STREAM_RECONNECT_MS = 3000;
+let recognitionSocket = null;
+let streamFrameDelay = STREAM_FRAME_DELAY_MS;
+
+function openRecognitionStream() {
+    if (!('WebSocket' in window)) {
+        startPolling();
+        return;
+    }
+    
+    const protocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(`${protocol}//${location.host}/ws/recognize?camera_id=${encodeURIComponent(cameraId)}`);
+    let opened = false;
+    
+    socket.addEventListener('open', () => {
+        opened = true;
+        recognitionSocket = socket;
+        sendStreamFrame();
+    });
+    
+    socket.addEventListener('message', async (event) => {
+        let delay = streamFrameDelay;
+        try {
+            const data = JSON.parse(event.data);
+            if (data.type === 'hello') {
+                // Ответ не на кадр: первый кадр уже отправлен при открытии соединения
+                streamFrameDelay = data.frame_delay_ms || STREAM_FRAME_DELAY_MS;
+                return;
+            }
+            if (data.type === 'busy') {
+                delay = STREAM_BUSY_DELAY_MS;
+            } else if (data.students && data.students.length > 0) {
+                for (const student of data.students) {
+                    showCheckinResult(student);
+                }
+            } else if (data.message) {
+                showHint(data.message);
+            }
+        } catch (error) {
+            console.error('Ошибка потокового распознавания:', error);
+        }
+        setTimeout(sendStreamFrame, delay);
+    });
+    
+    socket.addEventListener('close', () => {
+        recognitionSocket = null;
+        if (!stream) return;
+        if (opened) {
+            // Соединение оборвалось (перезапуск сервера, сеть) - переподключиться
+            setTimeout(openRecognitionStream, STREAM_RECONNECT_MS);
+        } else {
+            // Сервер не поддерживает потоковый канал - распознавание запросами
+            console.warn('Потоковое распознавание недоступно, используются HTTP-запросы');
+            startPolling();
+        }
+    });
+}
+
+async function sendStreamFrame() {
+    if (!recognitionSocket || recognitionSocket.readyState !== WebSocket.OPEN) return;
+    
+    captureFrame();
+    try {
+        // Кадры без лиц (по детектору браузера) не отправляются
+        if (faceDetector && (await faceDetector.detect(canvas)).length === 0) {
+            setTimeout(sendStreamFrame, streamFrameDelay);
+            return;
+        }
+    } catch (error) {
+        // Детектор браузера не сработал - отправить кадр целиком
+    }
+    recognitionSocket.send(await canvasToBlob(canvas));
+}
+
+function startPolling() {
+    if (!recognitionInterval) {
+        recognitionInterval = setInterval(autoRecognize, 2000);
+    }
+}
+
 // Автоматическое распознавание
 async function autoRecognize() {
     if (isProcessing) return;
@@ -37,19 +198,14 @@ async function autoRecognize() {
     isProcessing = true;
     
     // Захватить кадр
-    canvas.width = video.videoWidth;
-    canvas.height = video.videoHeight;
-    ctx.drawImage(video, 0, 0);
+    captureFrame();
     
-    // Конвертировать в blob
-    canvas.toBlob(async (blob) => {
-        const formData = new FormData();
-        formData.append('image', blob, 'capture.jpg');
-        
-        try {
-            const response = await fetch('/api/recognize_multiple', {
+    try {
+        const recognitionRequest = await buildRecognitionRequest();
+        if (recognitionRequest) {
+            const response = await fetch(recognitionRequest.url, {
                 method: 'POST',
-                body: formData
+                body: recognitionRequest.body
             });
             
             const data = await response.json();
@@ -57,7 +213,7 @@ async function autoRecognize() {
             if (data.success && data.count > 0) {
                 // Автоматически отметить всех распознанных учеников
                 for (const student of data.students) {
-                    await autoCheckInStudent(student);
+                    showCheckinResult(student);
                 }
                 
                 // Пауза 5 секунд перед продолжением сканирования
@@ -68,50 +224,43 @@ async function autoRecognize() {
                 }, 5000);
                 return;
             }
-        } catch (error) {
-            console.error('Ошибка распознавания:', error);
-        }
-        
-        isProcessing = false;
-    }, 'image/jpeg');
-}
-
-// Автоматическая отметка прихода ученика
-async function autoCheckInStudent(student) {
-    try {
-        const response = await fetch('/api/attendance/checkin', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ student_id: student.student_id })
-        });
-        
-        const data = await response.json();
-        
-        if (data.success) {
-            // Звуковое уведомление
-            playBeep();
             
-            // Показать уведомление
-            if (data.low_balance) {
-                showNotification(student.student_name, student.balance, data.remaining_balance, 'low');
-            } else {
-                showNotification(student.student_name, student.balance, data.remaining_balance, 'success');
+            // Лицо отклонено проверкой качества - подсказать, что поправить
+            if (data.rejected && Object.keys(data.rejected).length > 0) {
+                showHint(data.message);
             }
-            
-            loadTodayAttendance();
-            return true;
-        } else if (data.message === 'Уже отмечен сегодня') {
-            // Тихо пропустить - ученик уже был сегодня
-            console.log(`${student.student_name} уже отмечен сегодня`);
-            return false;
-        } else {
-            console.error('Ошибка отметки:', data.message);
-            return false;
         }
     } catch (error) {
-        console.error('Ошибка при отметке:', error);
-        return false;
+        console.error('Ошибка распознавания:', error);
     }
+    
+    isProcessing = false;
+}
+
+// Показать результат отметки прихода, выполненной сервером вместе с распознаванием
+function showCheckinResult(student) {
+    if (student.status === 'already_checked_in') {
+        // Тихо пропустить - ученик уже был сегодня
+        console.log(`${student.student_name} уже отмечен сегодня`);
+        return;
+    }
+    
+    // Звуковое уведомление
+    playBeep();
+    
+    if (student.low_balance) {
+        showNotification(student.student_name, student.balance, student.remaining_balance, 'low');
+    } else {
+        showNotification(student.student_name, student.balance, student.remaining_balance, 'success');
+    }
+    
+    loadTodayAttendance();
+}
+
+// Подсказка на киоске (подойти ближе, не двигаться, смотреть в камеру)
+function showHint(message) {
+    const resultDiv = document.getElementById('recognitionResult');
+    resultDiv.innerHTML = `<p class="info-text">💡 ${message}</p>`;
 }
 
 // Показать уведомление о регистрации
@@ -0,0 +1,22 @@
+"""
+Миграция: перевод students.face_encoding из JSON-текста в бинарную колонку
+(128 x float32 = 512 байт на ученика)
+
+Та же конвертация выполняется автоматически при старте приложения
+(ensure_students_columns); скрипт нужен, чтобы запустить её вручную
+"""
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, ensure_face_encoding_column
+
+
+def migrate_face_encodings():
+    with app.app_context():
+        ensure_face_encoding_column()
+        print("✅ Миграция завершена!")
+
+if __name__ == '__main__':
+    migrate_face_encodings()
@@ -112,9 +112,12 @@ Environment="FLASK_ENV=production"
 EnvironmentFile=$APP_DIR/.env
 Environment="PYTHONUNBUFFERED=1"
 
+# --threads 8: каждый киоск с /ws/recognize занимает поток воркера на всё время работы,
+# при 2 воркерах это не больше 8-10 киосков
 ExecStart=$APP_DIR/venv/bin/gunicorn \\
     --bind 127.0.0.1:5001 \\
     --workers 2 \\
+    --threads 8 \\
     --timeout 120 \\
     --access-logfile /var/log/$SERVICE_NAME/access.log \\
     --error-logfile /var/log/$SERVICE_NAME/error.log \\